@@ -0,0 +1,141 @@
+# 📥 Startup cost of loading listings.json: time until the bot can serve, time until every listing is
+# loaded and indexed, and peak RSS, for synthetic catalogues of growing size (generate_catalogue.py).
+# Every measurement runs in a fresh process. Runs the current loader in the foreground and with
+# LISTINGS_BACKGROUND_LOAD=1 and, with --baseline, the bot.py of another git revision for comparison;
+# 7b1de81~1 is the last revision that parses the whole of listings.json at once.
+# Usage: python benchmarks/bench_loader.py [--sizes 10000,100000] [--baseline 7b1de81~1] [--repeat 3] [--output results.json]
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# Runs in its own process, in the catalogue directory, with `bot_dir` holding the bot.py to measure
+async def run_load(bot_dir):
+    sys.path.insert(0, bot_dir)
+    import bot
+    import logging
+    bot.logger.setLevel(logging.WARNING)
+    startup_rss = peak_rss_mb()
+    # Revisions before the storage backends load the module-level dicts directly
+    storage = getattr(bot, "storage", None)
+    started = time.perf_counter()
+    if storage is not None:
+        await storage.load()
+    else:
+        await bot.load_user_data()
+        await bot.load_listings()
+    serving = time.perf_counter() - started
+    # Older revisions have no background loading; their load() returns with everything loaded
+    loaded = getattr(storage, "loaded", None)
+    if loaded is not None:
+        await loaded.wait()
+    ready = time.perf_counter() - started
+    result = {
+        "serving_ms": round(serving * 1000, 1), "loaded_ms": round(ready * 1000, 1),
+        "startup_rss_mb": startup_rss, "peak_rss_mb": peak_rss_mb(), "listings": len(bot.listings),
+    }
+    if storage is not None:
+        await storage.close()
+    if hasattr(bot, "fsm_storage"):
+        await bot.fsm_storage.close()
+    return result
+
+
+def export_revision(ref, directory):
+    source = subprocess.run(["git", "show", f"{ref}:bot.py"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    with open(os.path.join(directory, "bot.py"), 'w', encoding='utf-8') as f:
+        f.write(source)
+
+
+def measure(bot_dir, catalogue_dir, background):
+    # A copy per run: loading may archive expired listings or compact the journal
+    workdir = tempfile.mkdtemp(prefix="bench-loader-run-")
+    try:
+        for name in os.listdir(catalogue_dir):
+            shutil.copy(os.path.join(catalogue_dir, name), workdir)
+        env = {
+            **os.environ, "BOT_TOKEN": os.environ.get("BOT_TOKEN", "123456:BENCHMARK"), "ADMIN_ID": os.environ.get("ADMIN_ID", "1"),
+            "STORAGE_BACKEND": "json", "LISTINGS_BACKGROUND_LOAD": "1" if background else "0",
+        }
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--load", bot_dir], cwd=workdir, env=env, capture_output=True, text=True
+        )
+        if process.returncode != 0:
+            raise RuntimeError(f"load with {bot_dir} failed:\n{process.stderr[-2000:]}")
+        return json.loads(process.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Median of every measurement over the repeats
+def summarize(results):
+    return {key: round(statistics.median(result[key] for result in results), 1) for key in results[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and peak RSS of loading listings.json.")
+    parser.add_argument("--sizes", default="10000,100000")
+    parser.add_argument("--baseline", help="git revision whose bot.py is measured alongside the working tree")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--load", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load is not None:
+        print(json.dumps(asyncio.run(run_load(args.load))))
+        return
+
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from generate_catalogue import write_catalogue
+    loaders = [("current", REPO_DIR, False), ("current, background", REPO_DIR, True)]
+    baseline_dir = None
+    if args.baseline:
+        baseline_dir = tempfile.mkdtemp(prefix="bench-loader-baseline-")
+        export_revision(args.baseline, baseline_dir)
+        loaders.insert(0, (f"baseline {args.baseline}", baseline_dir, False))
+
+    runs = []
+    print(f"{'listings':>9}  {'loader':<28}{'serving ms':>12}{'loaded ms':>12}{'peak RSS MB':>13}{'startup RSS MB':>16}")
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            catalogue_dir = tempfile.mkdtemp(prefix=f"bench-loader-{size}-")
+            try:
+                listings_bytes, _ = write_catalogue(catalogue_dir, size, args.seed)
+                for name, bot_dir, background in loaders:
+                    result = summarize([measure(bot_dir, catalogue_dir, background) for _ in range(args.repeat)])
+                    runs.append({"size": size, "listings_json_mb": round(listings_bytes / 1e6, 2), "loader": name, **result})
+                    print(
+                        f"{size:>9}  {name:<28}{result['serving_ms']:>12.1f}{result['loaded_ms']:>12.1f}"
+                        f"{result['peak_rss_mb']:>13.1f}{result['startup_rss_mb']:>16.1f}"
+                    )
+            finally:
+                shutil.rmtree(catalogue_dir, ignore_errors=True)
+    finally:
+        if baseline_dir is not None:
+            shutil.rmtree(baseline_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"baseline": args.baseline, "seed": args.seed, "runs": runs}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
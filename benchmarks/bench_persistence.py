@@ -0,0 +1,112 @@
+# ⏱ Event-loop latency while listings.json is being saved.
+# Runs simulated handlers (a short await plus a little CPU work) next to a writer that keeps
+# calling write_listings(), and reports handler latency percentiles for growing catalogue sizes,
+# plus the time the event loop spends taking the snapshot that each save hands to the writer thread.
+# Usage: python benchmarks/bench_persistence.py [--sizes 1000,10000,100000] [--blocking]
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_ID", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def make_listings(count):
+    now = datetime.datetime.now()
+    return {
+        str(i): {
+            'id': str(i), 'user_id': 1000 + i % 500, 'category': bot.categories[i % len(bot.categories)],
+            'title': f"Silla de madera {i}", 'description': "Buen estado, poco uso. " * 4,
+            'photo_id': f"photo-{i}", 'additional_photo_ids': [f"photo-{i}-a", f"photo-{i}-b"],
+            'price': "Gratis" if i % 7 == 0 else f"{i % 90 + 1}.00", 'status': "free" if i % 7 == 0 else "sell",
+            'is_free': i % 7 == 0, 'location_type': 'city', 'city': bot.cities[i % len(bot.cities)],
+            'latitude': None, 'longitude': None, 'contact': "0999999999",
+            'posted_at': now, 'expires_at': now + datetime.timedelta(days=3), 'views': 0
+        }
+        for i in range(1, count + 1)
+    }
+
+
+def blocking_save_listings():
+    with open(bot.LISTINGS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(bot.listings, f, ensure_ascii=False, indent=4, default=str)
+
+
+# Median time of the snapshot step, the only part of a save that runs on the event loop
+def snapshot_ms(repeat=20):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        bot.snapshot_listings()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_size(count, duration, blocking):
+    bot.listings = make_listings(count)
+    latencies = []
+    saves = 0
+    stop = time.perf_counter() + duration
+
+    async def writer():
+        nonlocal saves
+        while time.perf_counter() < stop:
+            if blocking:
+                blocking_save_listings()
+            else:
+                await bot.write_listings()
+            saves += 1
+            await asyncio.sleep(0)
+
+    async def handler():
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            bot.get_item_card_keyboard(caller_is_search=True, current_index=1, total_results=3)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(writer(), *(handler() for _ in range(20)))
+    return {
+        'listings': count,
+        'saves': saves,
+        'handler_calls': len(latencies),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(max(latencies), 2),
+        'snapshot_ms': snapshot_ms(),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Event-loop latency while listings.json is being saved.")
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--blocking", action="store_true", help="dump on the event loop like the old save_listings() did")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench-persistence-"))
+    bot.logger.setLevel("INFO")
+    mode = "blocking" if args.blocking else "executor"
+    print(f"{'mode':<10}{'listings':>10}{'saves':>8}{'calls':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'snapshot ms':>13}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        result = await run_size(size, args.duration, args.blocking)
+        print(f"{mode:<10}{result['listings']:>10}{result['saves']:>8}{result['handler_calls']:>8}"
+              f"{result['p50_ms']:>9}{result['p99_ms']:>9}{result['max_ms']:>9}{result['snapshot_ms']:>13}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
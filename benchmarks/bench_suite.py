@@ -0,0 +1,174 @@
+# 📏 Storage and search microbenchmarks over synthetic catalogues of growing size.
+# For every size, generates listings.json/user_data.json (generate_catalogue.py) in a temporary directory
+# and runs a fresh process that times, in order: loading the stores, a full listings.json save (json
+# backend), 100 listing updates plus flush, a set of searches (ranked first page included), the category
+# and city counters, and item card rendering (display_item_card without the Telegram call). Peak RSS is
+# sampled after every stage; with STORAGE_BACKEND=sqlite, load includes the one-time import from JSON.
+# Prints a table and, with --output, writes JSON for comparing commits.
+# Usage: python benchmarks/bench_suite.py [--sizes 1000,10000,100000] [--output results.json]
+#        (--sizes 1000000 for the largest catalogue; STORAGE_BACKEND is honoured as in bot.py)
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+STAGES = ["load", "save", "update_100", "search", "count_by_category", "count_by_city", "render_card"]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def timings(samples):
+    samples = sorted(samples)
+    return {
+        "ops": len(samples), "total_ms": round(sum(samples), 3), "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3), "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def measure(func, *args):
+    started = time.perf_counter()
+    result = await func(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+# Runs in its own process, in the catalogue directory, so RSS and module state belong to one size
+async def run_stages(size, seed):
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    rng = random.Random(seed)
+    storage = bot.storage
+    stages = {"startup": {"peak_rss_mb": peak_rss_mb()}}
+
+    _, elapsed = await measure(storage.load)
+    stages["load"] = timings([elapsed])
+
+    if bot.STORAGE_BACKEND == "json":
+        _, elapsed = await measure(bot.write_listings)
+        stages["save"] = timings([elapsed])
+
+    now = datetime.datetime.now()
+    # The generator numbers listings 1..size; expired ones are gone after load
+    sample_ids = [str(listing_id) for listing_id in rng.sample(range(1, size + 1), min(2000, size))]
+    items = list((await storage.get_listings(sample_ids)).values())
+
+    samples = []
+    for item in items[:100]:
+        item = dict(item)
+        item['views'] = item.get('views', 0) + 1
+        _, elapsed = await measure(storage.update_listing, item)
+        samples.append(elapsed)
+    if samples:
+        _, elapsed = await measure(storage.flush)
+        samples[-1] += elapsed
+        stages["update_100"] = timings(samples)
+
+    keywords = ["", "", "silla", "mesa de", "lampara", "bicicleta usada", "telefono", "cama"]
+    categories = [None, None, bot.FREE_CATEGORY_ID] + [category_id for category_id, _, _ in bot.category_registry]
+    samples = []
+    for _ in range(200):
+        query = (rng.choice(keywords), rng.choice(categories), rng.choice([None, None] + bot.cities[:5]))
+        started = time.perf_counter()
+        results = await storage.search_listings(*query, now)
+        results[:5]
+        samples.append((time.perf_counter() - started) * 1000)
+    stages["search"] = timings(samples)
+
+    for stage, func in (("count_by_category", storage.count_listings_by_category), ("count_by_city", storage.count_listings_by_city)):
+        samples = []
+        for _ in range(50):
+            _, elapsed = await measure(func, now)
+            samples.append(elapsed)
+        stages[stage] = timings(samples)
+
+    samples = []
+    for item in items[:1000]:
+        started = time.perf_counter()
+        bot.render_item_card(item, "search")
+        samples.append((time.perf_counter() - started) * 1000)
+    if samples:
+        stages["render_card"] = timings(samples)
+
+    live_listings = sum((await storage.count_listings_by_city(now)).values())
+    await storage.close()
+    await bot.fsm_storage.close()
+    return {"backend": bot.STORAGE_BACKEND, "live_listings": live_listings, "stages": stages}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_size(size, args):
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from generate_catalogue import write_catalogue
+    directory = tempfile.mkdtemp(prefix=f"bench-suite-{size}-")
+    try:
+        started = time.perf_counter()
+        listings_bytes, users_bytes = write_catalogue(directory, size, args.seed)
+        generate_seconds = time.perf_counter() - started
+        env = {**os.environ, "BOT_TOKEN": os.environ.get("BOT_TOKEN", "123456:BENCHMARK"), "ADMIN_ID": os.environ.get("ADMIN_ID", "1")}
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--stages", str(size), "--seed", str(args.seed)],
+            cwd=directory, env=env, capture_output=True, text=True
+        )
+        if process.returncode != 0:
+            raise RuntimeError(f"stages for {size} listings failed:\n{process.stderr[-2000:]}")
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        return {"listings": size, "listings_json_mb": round(listings_bytes / 1e6, 2), "user_data_json_mb": round(users_bytes / 1e6, 2),
+                "generate_s": round(generate_seconds, 2), **result}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage and search microbenchmarks over synthetic catalogues.")
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--stages", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stages is not None:
+        print(json.dumps(asyncio.run(run_stages(args.stages, args.seed))))
+        return
+
+    runs = []
+    print(f"{'listings':>9}  {'stage':<18}{'ops':>6}{'p50 ms':>11}{'p95 ms':>11}{'total ms':>12}{'peak RSS MB':>13}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        run = run_size(size, args)
+        runs.append(run)
+        for stage in STAGES:
+            if stage in run["stages"]:
+                t = run["stages"][stage]
+                print(f"{size:>9}  {stage:<18}{t['ops']:>6}{t['p50_ms']:>11.3f}{t['p95_ms']:>11.3f}{t['total_ms']:>12.1f}{t['peak_rss_mb']:>13.1f}")
+    report = {
+        "commit": git_commit(), "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(), "platform": platform.platform(), "seed": args.seed, "runs": runs,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
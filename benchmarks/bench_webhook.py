@@ -0,0 +1,157 @@
+# 🌐 Update-to-response latency of the webhook entry point, without the Telegram network.
+# Starts a stub Bot API server, runs bot.py in webhook mode against it, posts synthetic updates from
+# distinct users and measures the time from each POST until the bot's first API call for that chat.
+# Usage: python benchmarks/bench_webhook.py [--updates 2000] [--concurrency 50] [--telegram-limits]
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import secrets
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+BOT_TOKEN = "123456:BENCHMARK"
+message_ids = itertools.count(1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def stub_message(chat_id):
+    return {"message_id": next(message_ids), "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}, "text": "ok"}
+
+
+# Minimal Bot API: answers every method with a plausible result and notes the first call per chat
+class StubBotApi:
+    def __init__(self):
+        self.first_response = {}
+        self.calls = 0
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        self.calls += 1
+        chat_id = form.get("chat_id")
+        if chat_id is not None:
+            self.first_response.setdefault(int(chat_id), time.perf_counter())
+        return web.json_response({"ok": True, "result": self.result(method, form)})
+
+    @staticmethod
+    def result(method, form):
+        chat_id = form.get("chat_id")
+        if method == "getme":
+            return {"id": 123456, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        if method == "sendmediagroup":
+            return [stub_message(chat_id) for _ in json.loads(form.get("media", "[]"))]
+        if method.startswith("send") or method.startswith("edit"):
+            return stub_message(chat_id or 0)
+        return True
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def make_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": user, "text": text
+    }}
+
+
+async def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"bot.py exited with code {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("bot.py did not start listening in time")
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    api, api_port, webhook_port = StubBotApi(), free_port(), free_port()
+    secret = secrets.token_hex(16)
+    api_runner = await api.start(api_port)
+    env = {
+        **os.environ, "BOT_TOKEN": BOT_TOKEN, "ADMIN_ID": "1", "BOT_MODE": "webhook",
+        "WEBHOOK_HOST": "127.0.0.1", "WEBHOOK_PORT": str(webhook_port), "WEBHOOK_PATH": "/webhook",
+        "WEBHOOK_SECRET": secret, "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}",
+    }
+    if not args.telegram_limits:
+        env.update(OUTBOUND_CHAT_RATE="100000", OUTBOUND_GLOBAL_RATE="100000", OUTBOUND_GLOBAL_BURST="100000")
+    workdir = tempfile.mkdtemp()
+    process = subprocess.Popen([sys.executable, BOT_PATH], cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_for_port(webhook_port, process)
+        sent = {}
+        texts = ["/start", "🔍 Buscar objeto", "📋 Mis anuncios"]
+        queue = asyncio.Queue()
+        for i in range(args.updates):
+            queue.put_nowait(i)
+        url = f"http://127.0.0.1:{webhook_port}/webhook"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+
+        async def poster(session):
+            while not queue.empty():
+                i = queue.get_nowait()
+                user_id = 100000 + i
+                sent[user_id] = time.perf_counter()
+                async with session.post(url, json=make_update(i + 1, user_id, texts[i % len(texts)]), headers=headers) as response:
+                    response.raise_for_status()
+
+        started = time.perf_counter()
+        async with ClientSession() as session:
+            await asyncio.gather(*(poster(session) for _ in range(args.concurrency)))
+        deadline = time.monotonic() + 30
+        while len(api.first_response) < len(sent) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        await api_runner.cleanup()
+
+    latencies = sorted((api.first_response[user_id] - sent[user_id]) * 1000 for user_id in sent if user_id in api.first_response)
+    print(f"{len(latencies)}/{len(sent)} updates answered in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} updates/s, {api.calls} API calls)")
+    if latencies:
+        print(
+            f"update -> first API call (ms): p50 {statistics.median(latencies):.1f}  p95 {percentile(latencies, 0.95):.1f}  "
+            f"p99 {percentile(latencies, 0.99):.1f}  max {latencies[-1]:.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the bot's default outbound rate limits")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
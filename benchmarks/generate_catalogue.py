@@ -0,0 +1,114 @@
+# 🏭 Synthetic catalogue: writes listings.json and user_data.json in the format bot.py loads.
+# Spanish titles and descriptions, a few big cities holding most listings (Zipf-like), categories
+# with uneven popularity, ~15% free items, some listings with coordinates and a mix of expiries:
+# already expired, expiring within hours, and fresh 3/5-day listings. Deterministic for a given seed.
+# Listings are streamed to disk one at a time, so even 1M listings need little memory.
+# Usage: python benchmarks/generate_catalogue.py --listings 10000 [--output-dir .] [--seed 1]
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("ADMIN_ID", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+NOUNS = [
+    "silla", "mesa", "lámpara", "bicicleta", "libro", "chaqueta", "teléfono", "cuna", "sofá", "guitarra",
+    "refrigeradora", "licuadora", "mochila", "zapatos", "televisor", "escritorio", "colchón", "patineta",
+    "cafetera", "microondas", "impresora", "ventilador", "balón", "muñeca", "vestido", "estante", "cama",
+]
+ADJECTIVES = ["nueva", "usada", "grande", "pequeña", "roja", "negra", "blanca", "antigua", "moderna", "plegable", "eléctrica"]
+MATERIALS = ["madera", "metal", "plástico", "cuero", "vidrio", "bambú"]
+PHRASES = [
+    "En buen estado", "Poco uso", "Como nueva", "Con detalles de uso", "Entrega inmediata",
+    "Solo retiro en domicilio", "Precio negociable", "Incluye accesorios", "Funciona perfectamente",
+    "Por mudanza", "Se entrega limpia", "Pregunte sin compromiso",
+]
+# Share of listings per category id, most popular first
+CATEGORY_WEIGHTS = [8, 14, 12, 16, 6, 9, 7, 10, 8, 10]
+
+
+# Cumulative, so rng.choices() does not re-add the weights on every draw
+def zipf_cum_weights(count, exponent=1.1):
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+city_cum_weights = zipf_cum_weights(len(bot.cities))
+category_cum_weights = list(itertools.accumulate(CATEGORY_WEIGHTS))
+
+
+def make_listing(listing_id, user_id, rng, now, city_points):
+    category_id, _, label = rng.choices(bot.category_registry, cum_weights=category_cum_weights)[0]
+    city = rng.choices(bot.cities, cum_weights=city_cum_weights)[0]
+    title = f"{rng.choice(NOUNS).capitalize()} {rng.choice(ADJECTIVES)}"
+    if rng.random() < 0.4:
+        title += f" de {rng.choice(MATERIALS)}"
+    roll = rng.random()
+    if roll < 0.1:
+        expires_at = now - datetime.timedelta(minutes=rng.randint(1, 2880))
+    elif roll < 0.3:
+        expires_at = now + datetime.timedelta(minutes=rng.randint(1, 720))
+    else:
+        expires_at = now + datetime.timedelta(minutes=rng.randint(720, 7200))
+    posted_at = expires_at - datetime.timedelta(days=rng.choice([3, 5]))
+    is_free = rng.random() < 0.15
+    item = {
+        'id': listing_id, 'user_id': user_id, 'category': label, 'category_id': category_id,
+        'title': title[:50], 'description': ". ".join(rng.sample(PHRASES, rng.randint(0, 3))),
+        'photo_id': f"photo-{listing_id}", 'additional_photo_ids': [f"photo-{listing_id}-{n}" for n in range(rng.randint(0, 3))],
+        'price': "Gratis" if is_free else f"{rng.choice([1, 2, 5, 10, 15, 20, 35, 50, 80, 120, 250]):.2f}",
+        'status': "free" if is_free else "sell", 'is_free': is_free,
+        'location_type': 'city', 'city': city, 'latitude': None, 'longitude': None,
+        'contact': f"09{rng.randint(10000000, 99999999)}",
+        'posted_at': str(posted_at), 'expires_at': str(expires_at), 'views': rng.randint(0, 50), 'version': 0
+    }
+    if rng.random() < 0.3:
+        latitude, longitude = city_points[city]
+        item.update(location_type='geolocation', latitude=latitude + rng.uniform(-0.05, 0.05), longitude=longitude + rng.uniform(-0.05, 0.05))
+    return item
+
+
+# Returns the sizes of the written files in bytes
+def write_catalogue(directory, count, seed=1):
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    city_points = {city: (rng.uniform(-3.5, 0.8), rng.uniform(-80.5, -77.5)) for city in bot.cities}
+    # A few heavy posters and a long tail of occasional ones
+    user_ids = list(range(1000, 1000 + max(1, count // 4)))
+    user_cum_weights = zipf_cum_weights(len(user_ids), 0.8)
+    user_data = {}
+    listings_path = os.path.join(directory, bot.LISTINGS_FILE)
+    with open(listings_path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for n in range(1, count + 1):
+            listing_id = str(n)
+            user_id = rng.choices(user_ids, cum_weights=user_cum_weights)[0] if n % 64 else rng.choice(user_ids)
+            item = make_listing(listing_id, user_id, rng, now, city_points)
+            user_data.setdefault(user_id, {"listings": [], "favorites": [], "banned": False})["listings"].append(listing_id)
+            f.write(f"{',' if n > 1 else ''}\n{json.dumps(listing_id)}:{json.dumps(item, ensure_ascii=False)}")
+        f.write('\n}\n')
+    user_data_path = os.path.join(directory, bot.USER_DATA_FILE)
+    with open(user_data_path, 'w', encoding='utf-8') as f:
+        json.dump(user_data, f, ensure_ascii=False)
+    return os.path.getsize(listings_path), os.path.getsize(user_data_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic listings.json and user_data.json.")
+    parser.add_argument("--listings", type=int, default=10000)
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    listings_size, users_size = write_catalogue(args.output_dir, args.listings, args.seed)
+    print(f"{args.listings} listings: {bot.LISTINGS_FILE} {listings_size / 1e6:.1f} MB, {bot.USER_DATA_FILE} {users_size / 1e6:.1f} MB in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# 🏋️ Load test of the real dispatcher with a simulated user population, without the Telegram network.
+# Starts a stub Bot API that adds latency and answers a share of chat-bound calls with 429, points bot.py at it,
+# seeds a catalogue and feeds dp concurrent users who run the create wizard, the search wizard with
+# paging, and title edits of their own listings. Users press the inline buttons the bot actually sent.
+# Reports updates/s, per-handler p50/p95/p99 latency and the outbound API calls per method.
+# Usage: python benchmarks/loadtest.py [--users 50] [--sessions 10] [--listings 2000] [--api-latency-ms 30]
+#        [--throttle-rate 0.005] [--retry-after 1] [--telegram-limits]
+# STORAGE_BACKEND and FSM_STORAGE are honoured as in bot.py.
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from bench_webhook import BOT_TOKEN, StubBotApi, free_port, percentile
+
+SCENARIOS = {"create": 0.3, "search": 0.5, "edit": 0.2}
+WORDS = ["silla", "mesa", "lampara", "bicicleta", "libro", "chaqueta", "telefono", "cuna", "sofa", "guitarra", "madera", "roja", "nueva"]
+update_ids = itertools.count(1)
+
+
+# Stub Bot API that behaves like a slow, occasionally throttling Telegram and remembers the last
+# inline keyboard sent to every chat, so simulated users can press real buttons.
+class LoadTestBotApi(StubBotApi):
+    def __init__(self, latency, throttle_rate, retry_after, seed):
+        super().__init__()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.methods = collections.Counter()
+        self.throttled = 0
+        self.keyboards = {}
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls += 1
+        self.methods[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        # Flood control applies to chat-bound calls, like Telegram's per-chat and global limits
+        if "chat_id" in form and self.random.random() < self.throttle_rate:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            })
+        result = self.result(method.lower(), form)
+        markup = json.loads(form.get("reply_markup") or "{}")
+        if "inline_keyboard" in markup and isinstance(result, dict):
+            message_id = int(form.get("message_id") or result["message_id"])
+            buttons = [button["callback_data"] for row in markup["inline_keyboard"] for button in row if "callback_data" in button]
+            self.keyboards[int(form["chat_id"])] = (message_id, buttons)
+        return web.json_response({"ok": True, "result": result})
+
+
+class SimulatedUser:
+    def __init__(self, user_id, bot_module, api, stats, rng):
+        self.user_id = user_id
+        self.bot = bot_module
+        self.api = api
+        self.stats = stats
+        self.random = rng
+
+    def user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"}
+
+    async def feed(self, payload):
+        update = self.bot.Update.model_validate({"update_id": next(update_ids), **payload}, context={"bot": self.bot.bot})
+        started = time.perf_counter()
+        await self.bot.dp.feed_update(self.bot.bot, update)
+        self.stats["updates"].append((time.perf_counter() - started) * 1000)
+
+    async def send(self, text=None, photo=None):
+        message = {"message_id": next(update_ids), "date": int(time.time()), "chat": {"id": self.user_id, "type": "private"}, "from": self.user()}
+        if text is not None:
+            message["text"] = text
+        if photo is not None:
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 800, "height": 600}]
+        await self.feed({"message": message})
+
+    # Presses a button of the last inline keyboard the bot sent; False when none matches
+    async def press(self, *prefixes):
+        message_id, buttons = self.api.keyboards.get(self.user_id, (None, []))
+        choices = [data for data in buttons if data.startswith(prefixes)]
+        if not choices:
+            return False
+        message = {
+            "message_id": message_id, "date": int(time.time()), "chat": {"id": self.user_id, "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "stub"}, "text": "card"
+        }
+        await self.feed({"callback_query": {
+            "id": str(next(update_ids)), "from": self.user(), "chat_instance": str(self.user_id),
+            "message": message, "data": self.random.choice(choices)
+        }})
+        return True
+
+    def title(self):
+        return " ".join(self.random.sample(WORDS, 2)).capitalize()
+
+    async def create(self):
+        await self.send("/start")
+        await self.send("🧳 Dejar objetos")
+        await self.send(self.random.choice(self.bot.categories))
+        await self.send(self.title())
+        await self.send(self.random.choice(["⏭️ Omitir", "En buen estado, " + " ".join(self.random.sample(WORDS, 3))]))
+        await self.send(photo=f"photo-{self.user_id}-{next(update_ids)}")
+        await self.send("⏭️ Omitir")
+        await self.send(self.random.choice(["Gratis", str(self.random.randint(1, 200))]))
+        await self.send(self.random.choice(self.bot.cities))
+        await self.send("🏙️ Solo ciudad")
+        await self.send("0999999999")
+        await self.send("📅 3 días")
+        return True
+
+    async def search(self):
+        await self.send("/start")
+        await self.send("🔍 Buscar objeto")
+        await self.send(self.random.choice(["⏭️ Omitir"] + WORDS))
+        if not await self.press("search_category_", "search_skip_category"):
+            return False
+        if not await self.press("search_city_", "search_skip_city"):
+            return False
+        for _ in range(self.random.randint(1, 4)):
+            if not await self.press("search_next_"):
+                return False
+        if not await self.press("back_to_search_results"):
+            return False
+        await self.press("show_more_results")
+        return True
+
+    async def edit(self):
+        await self.send("/start")
+        await self.send("📋 Mis anuncios")
+        if not await self.press("view_item_"):
+            return False
+        if not await self.press("edit_item_"):
+            return False
+        await self.send("✏️ Título")
+        await self.send(self.title())
+        return True
+
+    async def run(self, sessions):
+        names = list(SCENARIOS)
+        for _ in range(sessions):
+            name = self.random.choices(names, weights=[SCENARIOS[n] for n in names])[0]
+            completed = await getattr(self, name)()
+            self.stats["scenarios"][name, completed] += 1
+
+
+async def seed_catalogue(bot_module, count, rng):
+    now = datetime.datetime.now()
+    for i in range(count):
+        category_id, _, label = rng.choice(bot_module.category_registry)
+        is_free = rng.random() < 0.15
+        await bot_module.storage.create_listing({
+            'id': await bot_module.storage.generate_listing_id(), 'user_id': 1 + i % 500,
+            'category': label, 'category_id': category_id,
+            'title': " ".join(rng.sample(WORDS, 2)).capitalize(), 'description': " ".join(rng.sample(WORDS, 5)),
+            'photo_id': f"seed-{i}", 'additional_photo_ids': [f"seed-{i}-a"] if i % 3 == 0 else [],
+            'price': "Gratis" if is_free else f"{rng.randint(1, 200)}.00", 'status': "free" if is_free else "sell",
+            'is_free': is_free, 'location_type': 'city', 'city': rng.choice(bot_module.cities),
+            'latitude': None, 'longitude': None, 'contact': "0999999999",
+            'posted_at': now - datetime.timedelta(hours=rng.randint(0, 72)),
+            'expires_at': now + datetime.timedelta(hours=rng.randint(1, 120)), 'views': 0, 'version': 0
+        })
+
+
+def latency_row(name, values):
+    values = sorted(values)
+    return (
+        f"{name:<36}{len(values):>8}{statistics.median(values):>9.1f}{percentile(values, 0.95):>9.1f}"
+        f"{percentile(values, 0.99):>9.1f}{values[-1]:>9.1f}"
+    )
+
+
+async def run(args):
+    api_port = free_port()
+    api = LoadTestBotApi(args.api_latency_ms / 1000, args.throttle_rate, args.retry_after, args.seed)
+    api_runner = await api.start(api_port)
+    os.environ.update(BOT_TOKEN=BOT_TOKEN, ADMIN_ID="1", TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}")
+    if not args.telegram_limits:
+        os.environ.update(OUTBOUND_CHAT_RATE="100000", OUTBOUND_GLOBAL_RATE="100000", OUTBOUND_GLOBAL_BURST="100000")
+    os.chdir(tempfile.mkdtemp(prefix="loadtest-"))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot as bot_module
+    import logging
+    bot_module.logger.setLevel(logging.WARNING)
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
+    # Inner middlewares see the handler that matched, so every update is timed under its handler's name
+    stats = {"updates": [], "handlers": collections.defaultdict(list), "scenarios": collections.Counter()}
+
+    async def time_handler(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            stats["handlers"][data["handler"].callback.__name__].append((time.perf_counter() - started) * 1000)
+
+    bot_module.dp.message.middleware(time_handler)
+    bot_module.dp.callback_query.middleware(time_handler)
+
+    rng = random.Random(args.seed)
+    try:
+        await bot_module.storage.load()
+        await seed_catalogue(bot_module, args.listings, rng)
+        api.methods.clear()
+        api.calls = api.throttled = 0
+        users = [SimulatedUser(500000 + i, bot_module, api, stats, random.Random(rng.random())) for i in range(args.users)]
+        started = time.perf_counter()
+        await asyncio.gather(*(user.run(args.sessions) for user in users))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot_module.storage.close()
+        await bot_module.fsm_storage.close()
+        await bot_module.bot.session.close()
+        await api_runner.cleanup()
+
+    updates = stats["updates"]
+    print(
+        f"{len(users)} users, {sum(stats['scenarios'].values())} scenarios, {len(updates)} updates in {elapsed:.2f}s "
+        f"({len(updates) / elapsed:.0f} updates/s) over {args.listings} seeded listings ({bot_module.STORAGE_BACKEND} backend)"
+    )
+    print("scenarios: " + ", ".join(
+        f"{name} {stats['scenarios'][name, True]} done/{stats['scenarios'][name, False]} ended early" for name in SCENARIOS
+    ))
+    print(f"\n{'handler':<36}{'calls':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, values in sorted(stats["handlers"].items(), key=lambda entry: -len(entry[1])):
+        print(latency_row(name, values))
+    print(latency_row("(any update)", updates))
+    print(f"\noutbound API calls: {api.calls} ({api.throttled} answered with 429)")
+    for method, count in api.methods.most_common():
+        print(f"  {method:<34}{count:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the bot's handlers against a stub Bot API.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--sessions", type=int, default=10, help="scenarios run by every user, one after another")
+    parser.add_argument("--listings", type=int, default=2000, help="listings seeded before the users start")
+    parser.add_argument("--api-latency-ms", type=float, default=30.0, help="mean delay of every stub API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.005, help="share of chat-bound API calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of the injected 429s, in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the bot's default outbound rate limits")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,94 @@
+import abc
 import asyncio
+import atexit
+import bisect
+import collections
+import contextlib
+import contextvars
 import json
 import datetime
+import functools
+import gc
+import heapq
+import itertools
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import queue
+import re
+import secrets
+import shutil
+import signal
+import sqlite3
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from html import escape
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton, Location, InputMediaPhoto,
-    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update
 )
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiohttp import web
 from dotenv import load_dotenv
 
+# 🔧 Load environment variables (before logging, since .env may set LOG_LEVEL)
+load_dotenv()
+
 # 📝 Logging configuration
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s', handlers=[logging.StreamHandler()])
+# LOG_LEVEL is the threshold (DEBUG, INFO, WARNING, ...). Handlers only put records on a queue; a listener
+# thread formats and writes them, so log I/O never blocks the event loop. Per-update trace lines (the
+# bot's trace logger, aiogram's "Update ... is handled" and aiohttp's access log) are sampled: one in
+# LOG_TRACE_EVERY is kept, warnings and errors always are.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_TRACE_EVERY = max(1, int(os.getenv("LOG_TRACE_EVERY", "100")))
+
+# Passes records through untouched: formatting happens in the listener thread, which is safe because
+# log calls pass their arguments lazily as plain values
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+class TraceSampler(logging.Filter):
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        self.seen += 1
+        return self.seen % self.every == 1 or self.every == 1
+
+log_queue = queue.SimpleQueue()
+log_output = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_output)
+log_level_known = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(level=LOG_LEVEL if log_level_known else logging.INFO, handlers=[DeferredQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger(f"{__name__}.trace")
+for sampled_logger in (trace_logger, logging.getLogger("aiogram.event"), logging.getLogger("aiohttp.access")):
+    sampled_logger.addFilter(TraceSampler(LOG_TRACE_EVERY))
+if not log_level_known:
+    logger.warning(f"⚠️ Unknown LOG_LEVEL '{LOG_LEVEL}', using INFO.")
 
-# 🔧 Load environment variables
-load_dotenv()
 API_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 
@@ -39,17 +104,407 @@ except ValueError:
     logger.error("❌ ADMIN_ID is not a valid integer.")
     exit(1)
 
+# 💾 Storage configuration
+# STORAGE_BACKEND=json keeps listings in memory and in JSON files; STORAGE_BACKEND=sqlite keeps them in SQLITE_PATH.
+# With the json backend, STORAGE_MODE=journal appends one record per listing mutation to LISTINGS_JOURNAL_FILE
+# and periodically compacts it into LISTINGS_FILE; STORAGE_MODE=json rewrites LISTINGS_FILE every time.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+STORAGE_MODE = os.getenv("STORAGE_MODE", "journal").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "loop_market.db")
+EXPIRY_CHECK_INTERVAL = float(os.getenv("EXPIRY_CHECK_INTERVAL", "60"))
+JOURNAL_COMPACT_THRESHOLD = int(os.getenv("JOURNAL_COMPACT_THRESHOLD", "500"))
+SAVE_INTERVAL = float(os.getenv("SAVE_INTERVAL", "2"))
+SAVE_MAX_PENDING = int(os.getenv("SAVE_MAX_PENDING", "50"))
+# With the json backend, LISTINGS_BACKGROUND_LOAD=1 starts serving updates while listings.json is still being
+# read; anything that touches listings waits until loading finishes
+LISTINGS_BACKGROUND_LOAD = os.getenv("LISTINGS_BACKGROUND_LOAD", "0") == "1"
+# Number of materialized search result lists shared between users' search sessions
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+# Seconds a cached result list may answer new searches before the query is run again
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+# Number of listings whose rendered item cards are kept in memory
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "1024"))
+# Radius of the "📍 Cerca de mí" search, in kilometres
+NEARBY_RADIUS_KM = float(os.getenv("NEARBY_RADIUS_KM", "10"))
+USER_DATA_FILE = 'user_data.json'
+LISTINGS_FILE = 'listings.json'
+LISTINGS_JOURNAL_FILE = 'listings.journal'
+LISTINGS_JOURNAL_ROTATED_FILE = 'listings.journal.old'
+LISTINGS_ARCHIVE_FILE = 'listings_archive.jsonl'
+LISTING_IDS_FILE = 'listing_ids.json'
+if STORAGE_BACKEND not in ("json", "sqlite"):
+    logger.error(f"❌ Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', expected 'json' or 'sqlite'.")
+    exit(1)
+if STORAGE_MODE not in ("journal", "json"):
+    logger.error(f"❌ Unknown STORAGE_MODE '{STORAGE_MODE}', expected 'journal' or 'json'.")
+    exit(1)
+
+# 🧠 FSM storage configuration
+# FSM_STORAGE=sqlite keeps wizard states in FSM_SQLITE_PATH so they survive restarts; FSM_STORAGE=memory
+# keeps them in process memory. States idle for longer than FSM_STATE_TTL seconds are evicted.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm_states.db")
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+if FSM_STORAGE not in ("sqlite", "memory"):
+    logger.error(f"❌ Unknown FSM_STORAGE '{FSM_STORAGE}', expected 'sqlite' or 'memory'.")
+    exit(1)
+
+# 🧠 FSM storage: one row per chat/user key with its state and JSON data, nothing cached in memory.
+# Rows untouched for FSM_STATE_TTL seconds read as empty and are deleted by evict_idle.
+# It has its own connection and thread: aiogram reads the state on every update, so it must not
+# queue behind listing snapshots and compactions on the persistence thread.
+class SqliteFsmStorage(BaseStorage):
+    schema = """CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at REAL NOT NULL
+    )"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.conn = None
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    def connect_sync(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(self.schema)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states(updated_at)")
+        return self.conn
+
+    def read_sync(self, key, column):
+        row = self.connect_sync().execute(
+            f"SELECT {column} FROM fsm_states WHERE key = ? AND updated_at > ?", (key, time.time() - self.ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def write_sync(self, key, column, value):
+        conn = self.connect_sync()
+        with conn:
+            # An expired row must not leak its other column into the new state
+            conn.execute("DELETE FROM fsm_states WHERE key = ? AND updated_at <= ?", (key, time.time() - self.ttl))
+            conn.execute(
+                f"INSERT INTO fsm_states (key, {column}, updated_at) VALUES (?, ?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at",
+                (key, value, time.time())
+            )
+            conn.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+    def evict_idle_sync(self):
+        with self.connect_sync() as conn:
+            return conn.execute("DELETE FROM fsm_states WHERE updated_at <= ?", (time.time() - self.ttl,)).rowcount
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self.run(self.write_sync, self.key_builder.build(key), "state", state)
+
+    async def get_state(self, key):
+        return await self.run(self.read_sync, self.key_builder.build(key), "state")
+
+    async def set_data(self, key, data):
+        await self.run(self.write_sync, self.key_builder.build(key), "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key):
+        data = await self.run(self.read_sync, self.key_builder.build(key), "data")
+        return json.loads(data) if data else {}
+
+    async def evict_idle(self):
+        evicted = await self.run(self.evict_idle_sync)
+        if evicted:
+            logger.info(f"🧹 Evicted {evicted} idle FSM states.")
+        return evicted
+
+    def close_sync(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def close(self):
+        await self.run(self.close_sync)
+        self.executor.shutdown()
+
+# 🌐 Update delivery
+# BOT_MODE=polling pulls updates with getUpdates; BOT_MODE=webhook serves WEBHOOK_PATH on WEBHOOK_HOST:WEBHOOK_PORT
+# and, if WEBHOOK_BASE_URL is set, registers WEBHOOK_BASE_URL + WEBHOOK_PATH with Telegram on startup.
+# TELEGRAM_API_URL points the bot at another Bot API server (a local one, or a stub for benchmarks).
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# WORKERS > 1 runs that many webhook processes on the same port (SO_REUSEPORT) over the shared SQLite
+# stores; each worker picks up the others' listing changes from the change log every CHANGE_POLL_INTERVAL.
+WORKERS = int(os.getenv("WORKERS", "1"))
+CHANGE_POLL_INTERVAL = float(os.getenv("CHANGE_POLL_INTERVAL", "0.5"))
+if BOT_MODE not in ("polling", "webhook"):
+    logger.error(f"❌ Unknown BOT_MODE '{BOT_MODE}', expected 'polling' or 'webhook'.")
+    exit(1)
+if WORKERS > 1 and (BOT_MODE != "webhook" or STORAGE_BACKEND != "sqlite" or FSM_STORAGE != "sqlite"):
+    logger.error("❌ WORKERS > 1 needs BOT_MODE=webhook, STORAGE_BACKEND=sqlite and FSM_STORAGE=sqlite.")
+    exit(1)
+# The secret is the only thing telling Telegram's requests from forged ones, so webhook mode never runs without it.
+# When the bot registers the webhook itself it can pick one; spawned workers inherit it through the environment.
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    if not WEBHOOK_BASE_URL:
+        logger.error("❌ BOT_MODE=webhook needs WEBHOOK_SECRET, or WEBHOOK_BASE_URL to register the webhook with a generated secret.")
+        exit(1)
+    WEBHOOK_SECRET = os.environ["WEBHOOK_SECRET"] = secrets.token_urlsafe(32)
+    logger.info("🔑 WEBHOOK_SECRET not set, generated one for this run.")
+
+# 📈 Metrics
+# METRICS_PORT > 0 serves Prometheus text-format metrics on METRICS_HOST:METRICS_PORT/metrics; with WORKERS > 1,
+# worker N listens on METRICS_PORT + N - 1. METRICS_LOG_INTERVAL > 0 logs a summary every that many seconds.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+# Position of this process among the webhook workers, 0 for a single process
+worker_index = 0
+
+# Upper bounds, in seconds, of the latency histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Upper bound of the bucket holding the quantile, so "p95 <= 50 ms" rather than an exact value
+    def quantile(self, fraction):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (math.inf,), self.counts):
+            cumulative += count
+            if cumulative >= fraction * self.count:
+                return bound
+        return math.inf
+
+# In-process counters and histograms; everything is updated on the event loop, so no locking
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.updates = 0
+        self.handlers = collections.defaultdict(Histogram)
+        self.handler_errors = collections.Counter()
+        self.states = collections.Counter()
+        self.api_calls = collections.defaultdict(Histogram)
+        self.api_errors = collections.Counter()
+        self.saves = collections.defaultdict(Histogram)
+
+    @contextlib.contextmanager
+    def timer(self, histograms, key):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histograms[key].observe(time.perf_counter() - started)
+
+metrics = Metrics()
+
+# 🚦 Outbound rate limits
+# Telegram allows roughly one message per second per chat (short bursts are tolerated) and about
+# 30 requests per second overall; going over either returns 429 RetryAfter.
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "6"))
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_GLOBAL_BURST = float(os.getenv("OUTBOUND_GLOBAL_BURST", "30"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Lower value is served first when requests queue for the global limit
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 1
+outbound_priority_var = contextvars.ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+# Requests made inside this block (e.g. broadcasts from a background task) yield to handler replies.
+# Nothing sends from the background yet, so every request currently goes out as interactive.
+@contextlib.contextmanager
+def outbound_priority(priority):
+    token = outbound_priority_var.set(priority)
+    try:
+        yield
+    finally:
+        outbound_priority_var.reset(token)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    # Takes a token and returns 0, or returns the seconds until one will be available
+    def take(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self):
+        return time.monotonic() >= self.paused_until and self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+# Global limit shared by all chats: requests wait in a heap ordered by (priority, arrival) and a
+# single drain task hands out tokens as they refill.
+class PriorityLimiter:
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self.waiters = []
+        self.arrivals = itertools.count()
+        self.drain_task = None
+
+    async def acquire(self, priority):
+        if not self.waiters and self.bucket.take() == 0:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.arrivals), waiter))
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = asyncio.create_task(self.drain())
+        await waiter
+
+    async def drain(self):
+        while self.waiters:
+            if self.waiters[0][2].cancelled():
+                heapq.heappop(self.waiters)
+                continue
+            delay = self.bucket.take()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self.waiters)[2].set_result(None)
+
+# Session middleware every Bot API call passes through: new messages wait for their chat's bucket,
+# every call (callback answers and other chat-less methods included) waits for the global limiter,
+# and 429s pause the global bucket, plus the chat's, and retry.
+# Calls for different chats never wait on each other beyond the global rate.
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self):
+        self.chat_buckets = {}
+        # Workers share the bot's global limit
+        self.global_limiter = PriorityLimiter(OUTBOUND_GLOBAL_RATE / WORKERS, max(1.0, OUTBOUND_GLOBAL_BURST / WORKERS))
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    # One attempt at the API, timed and counted per method
+    async def send(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.api_errors[name, type(e).__name__] += 1
+            raise
+        finally:
+            metrics.api_calls[name].observe(time.perf_counter() - started)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        is_send = chat_id is not None and type(method).__name__.startswith("Send")
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            if is_send:
+                bucket = self.chat_bucket(chat_id)
+                while delay := bucket.take():
+                    await asyncio.sleep(delay)
+            await self.global_limiter.acquire(outbound_priority_var.get())
+            try:
+                return await self.send(make_request, bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(f"⚠️ Flood control on {type(method).__name__}{f' in chat {chat_id}' if chat_id is not None else ''}, retrying in {e.retry_after}s")
+                # The limit hit may be the bot-wide one, so other chats hold off as well
+                self.global_limiter.bucket.pause(e.retry_after)
+                if chat_id is not None:
+                    self.chat_bucket(chat_id).pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
 # 🤖 Bot and Dispatcher initialization
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=bot_session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+outbound_scheduler = OutboundScheduler()
+bot.session.middleware(outbound_scheduler)
+fsm_storage = SqliteFsmStorage(FSM_SQLITE_PATH, FSM_STATE_TTL) if FSM_STORAGE == "sqlite" else MemoryStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+# 📈 Handler metrics: inner middlewares run once a handler has matched, so they know its name and
+# the FSM state the update arrived in. Updates no handler takes are only counted.
+class HandlerMetrics(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        metrics.states[data.get("raw_state") or "none"] += 1
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.handler_errors[name, type(e).__name__] += 1
+            raise
+        finally:
+            metrics.handlers[name].observe(time.perf_counter() - started)
+
+async def count_update(handler, event, data):
+    metrics.updates += 1
+    return await handler(event, data)
+
+handler_metrics = HandlerMetrics()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+dp.update.outer_middleware(count_update)
 
 # 📊 Global data structures
 user_data = {}
 listings = {}
-categories = [
-    "📦 ¡Kit de mudanza!", "🛋️ Muebles", "📱 Electrónica", "👗 Ropa", "👜 Accesorios",
-    "📚 Libros", "🧸 Juguetes", "🔌 Electrodomésticos", "🏀 Deportes", "🌟 Otros"
+journal_record_count = 0
+# Highest numeric listing id in the journals read at load, deletes included
+journal_max_listing_id = 0
+journal_compaction_task = None
+# 🏷 Category registry: (id, slug, display label). Listings store the id; the slug goes into
+# callback_data. Ids are persisted, so never renumber them, only append.
+category_registry = [
+    (1, "kit", "📦 ¡Kit de mudanza!"), (2, "muebles", "🛋️ Muebles"), (3, "electronica", "📱 Electrónica"),
+    (4, "ropa", "👗 Ropa"), (5, "accesorios", "👜 Accesorios"), (6, "libros", "📚 Libros"),
+    (7, "juguetes", "🧸 Juguetes"), (8, "electrodomesticos", "🔌 Electrodomésticos"),
+    (9, "deportes", "🏀 Deportes"), (10, "otros", "🌟 Otros")
 ]
+# Pseudo-category of the search wizard matching every free listing
+FREE_CATEGORY_ID = 0
+FREE_CATEGORY_SLUG = "gratis"
+categories = [label for _, _, label in category_registry]
+category_ids = [category_id for category_id, _, _ in category_registry]
+category_labels = {category_id: label for category_id, _, label in category_registry}
+category_slugs = {category_id: slug for category_id, slug, _ in category_registry}
+category_ids_by_slug = {slug: category_id for category_id, slug, _ in category_registry}
+category_ids_by_slug[FREE_CATEGORY_SLUG] = FREE_CATEGORY_ID
+# Older listings may carry the label without its emoji, so both spellings resolve
+category_ids_by_label = {label: category_id for category_id, _, label in category_registry}
+category_ids_by_label.update({label.split(' ', 1)[1]: category_id for category_id, _, label in category_registry})
 cities = [
     "Quito", "Guayaquil", "Cuenca", "Santo Domingo", "Manta",
     "Portoviejo", "Ambato", "Riobamba", "Loja", "Ibarra",
@@ -68,23 +523,31 @@ cancel_keyboard = ReplyKeyboardMarkup(
 main_keyboard = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="🧳 Dejar objetos"), KeyboardButton(text="🔍 Buscar objeto")],
-        [KeyboardButton(text="📋 Mis anuncios")]
+        [KeyboardButton(text="📋 Mis anuncios"), KeyboardButton(text="📍 Cerca de mí")]
     ],
     resize_keyboard=True
 )
 
-def get_categories_keyboard(is_search=False):
+nearby_location_keyboard = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📍 Enviar mi ubicación", request_location=True)],
+        [KeyboardButton(text="❌ Cancelar")]
+    ],
+    resize_keyboard=True
+)
+
+async def get_categories_keyboard(is_search=False):
     if is_search:
-        counts = count_listings_by_category()
+        counts = await count_listings_by_category()
         keyboard = []
         row = []
-        row.append(InlineKeyboardButton(text=f"♾ Solo Gratis ({counts.get('Gratis', 0)})", callback_data="search_category_Gratis"))
+        row.append(InlineKeyboardButton(text=f"♾ Solo Gratis ({counts.get(FREE_CATEGORY_ID, 0)})", callback_data=f"search_category_{FREE_CATEGORY_SLUG}"))
         keyboard.append(row)
         row = []
-        for i, category in enumerate(categories):
-            button_text = f"{category} ({counts.get(category.replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', ''), 0)})"
-            row.append(InlineKeyboardButton(text=button_text, callback_data=f"search_category_{category.replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', '')}"))
-            if (i + 1) % 2 == 0 or i == len(categories) - 1:
+        for i, (category_id, slug, category) in enumerate(category_registry):
+            button_text = f"{category} ({counts.get(category_id, 0)})"
+            row.append(InlineKeyboardButton(text=button_text, callback_data=f"search_category_{slug}"))
+            if (i + 1) % 2 == 0 or i == len(category_registry) - 1:
                 keyboard.append(row)
                 row = []
         keyboard.append([InlineKeyboardButton(text="⏭️ Omitir", callback_data="search_skip_category")])
@@ -95,8 +558,8 @@ def get_categories_keyboard(is_search=False):
         keyboard.append([KeyboardButton(text="❌ Cancelar")])
         return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
-def get_cities_keyboard():
-    counts = count_listings_by_city()
+async def get_cities_keyboard():
+    counts = await count_listings_by_city()
     keyboard = []
     row = []
     for i, city in enumerate(cities):
@@ -156,9 +619,11 @@ def get_confirm_delete_keyboard(listing_id):
         [InlineKeyboardButton(text="❌ No", callback_data="cancel")]
     ])
 
-def get_item_card_keyboard(caller_is_search=False, caller_is_edit=False, current_index=0, total_results=0, listing_id=None):
+def get_item_card_keyboard(caller_is_search=False, caller_is_edit=False, current_index=0, total_results=0, listing_id=None, photo_count=0):
     keyboard_buttons = []
     if caller_is_search:
+        if photo_count > 1:
+            keyboard_buttons.append([InlineKeyboardButton(text=f"🖼 Ver todas las fotos ({photo_count})", callback_data=f"search_photos_{listing_id}")])
         if total_results > 1:
             nav_buttons = []
             if current_index > 0:
@@ -208,15 +673,45 @@ class SearchForm(StatesGroup):
     keyword = State()
     category = State()
     city = State()
+    nearby_location = State()
 
 # 💾 Data handling functions
+# All file I/O and JSON (de)serialization runs on a single dedicated thread: the event loop
+# only takes cheap snapshots of the dicts, and the FIFO executor keeps writes in order.
+persistence_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+
+async def run_persistence(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(persistence_executor, functools.partial(func, *args))
+
+# Copies two levels deep (records and their list fields) so the writer thread never sees
+# a dict or list that a handler is mutating at the same time.
+def snapshot_records(records):
+    return {k: {field: list(value) if isinstance(value, list) else value for field, value in v.items()} for k, v in records.items()}
+
+# Stored listings are copy-on-write: edit handlers change a copy (get_selected_listing) and store it
+# with update_listing, so a shallow copy of the dict is a consistent snapshot for the writer thread.
+def snapshot_listings():
+    return dict(listings)
+
+def read_json_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_json_atomic(path, data, indent=None):
+    tmp_path = f"{path}.tmp"
+    separators = None if indent else (',', ':')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent, separators=separators, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 async def load_user_data():
+    global user_data
     try:
-        if os.path.exists('user_data.json'):
-            with open('user_data.json', 'r', encoding='utf-8') as f:
-                global user_data
-                user_data = json.load(f)
-                user_data = {int(k): v for k, v in user_data.items()}
+        if os.path.exists(USER_DATA_FILE):
+            loaded_user_data = await run_persistence(read_json_file, USER_DATA_FILE)
+            user_data = {int(k): v for k, v in loaded_user_data.items()}
             logger.info("✅ User data loaded successfully.")
         else:
             logger.info("ℹ️ user_data.json not found, starting with empty user_data.")
@@ -227,96 +722,1598 @@ async def load_user_data():
         logger.error(f"❌ Failed to load user_data: {e}")
         user_data = {}
 
-async def save_user_data():
+async def write_user_data():
     try:
-        with open('user_data.json', 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=4, default=str)
+        await run_persistence(write_json_atomic, USER_DATA_FILE, snapshot_records(user_data), 4)
         logger.debug("💾 User data saved.")
     except Exception as e:
         logger.error(f"❌ Failed to save user_data: {e}")
 
-async def load_listings():
+# Last operation per listing id across the journals: the item for a put, None for a delete
+def replay_listings_journal(path, journal_ops):
+    applied = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                if record['op'] == 'put':
+                    journal_ops[record['id']] = record['item']
+                elif record['op'] == 'delete':
+                    journal_ops[record['id']] = None
+                else:
+                    raise ValueError(f"unknown op '{record['op']}'")
+                applied += 1
+            except (ValueError, KeyError, TypeError) as e:
+                # A torn last line after a crash is expected; anything else is worth a look
+                logger.warning(f"⚠️ Skipping invalid journal record {path}:{line_no}: {e}")
+    return applied
+
+def read_journal_files(journal_files):
+    journal_ops = {}
+    applied = 0
+    for path in journal_files:
+        applied += replay_listings_journal(path, journal_ops)
+    return journal_ops, applied
+
+# 📥 Streaming reader for listings.json: decodes the top-level object one listing at a time from
+# LOAD_CHUNK_SIZE reads, so neither the whole text nor a second copy of every listing is held at once.
+# Batches are read on the persistence thread; the event loop normalizes and indexes each one.
+# The decoder only shares equal key strings within one call, so the reader maps every listing's keys
+# to one shared copy itself; otherwise each listing would hold its own 20-odd key strings.
+LOAD_CHUNK_SIZE = 1 << 20
+LOAD_BATCH_SIZE = 1000
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_COLON = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
+JSON_SEPARATOR = re.compile(r'[ \t\n\r]*([,}])[ \t\n\r]*')
+
+class ListingsFileReader:
+    def __init__(self, path):
+        self.file = open(path, 'r', encoding='utf-8')
+        self.scan_once = json.JSONDecoder().scan_once
+        self.keys = {}
+        self.buffer = ''
+        self.pos = 0
+        if self.peek() != '{':
+            self.file.close()
+            raise json.JSONDecodeError("Expecting '{'", self.buffer, self.pos)
+        self.pos += 1
+        self.finished = self.peek() == '}'
+
+    # Drops the consumed text and appends the next chunk; False at end of file
+    def fill(self):
+        chunk = self.file.read(LOAD_CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    # Next non-whitespace character, reading on as needed; '' at end of file
+    def peek(self):
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    # Up to `count` (listing_id, raw listing) pairs; an empty list once the object is closed.
+    # A listing cut by the end of the buffer fails to decode (keys are strings and listings objects,
+    # so neither can end early) and is decoded again after the next chunk is read.
+    def read_batch(self, count):
+        batch = []
+        keys = self.keys
+        while not self.finished and len(batch) < count:
+            self.peek()
+            buffer = self.buffer
+            try:
+                listing_id, pos = self.scan_once(buffer, self.pos)
+                pos = JSON_COLON.match(buffer, pos).end()
+                item, pos = self.scan_once(buffer, pos)
+                separator = JSON_SEPARATOR.match(buffer, pos)
+                self.pos = separator.end()
+            except (StopIteration, json.JSONDecodeError, AttributeError) as e:
+                if self.fill():
+                    continue
+                raise json.JSONDecodeError("Invalid or truncated listing", self.buffer, self.pos) from e
+            if isinstance(item, dict):
+                item = {keys.setdefault(key, key): value for key, value in item.items()}
+            batch.append((listing_id, item))
+            self.finished = separator.group(1) == '}'
+        return batch
+
+    def close(self):
+        self.file.close()
+
+# Every loaded listing is long-lived, so collections triggered by the allocation count during the load
+# would only re-scan the growing heap. Afterwards the loaded objects are frozen out of the collector's
+# reach, so later full collections do not walk them either; reference counting still frees them.
+# Only for loads that finish before serving starts: during a background load the pause would cover
+# handlers too, and the freeze would pin their in-flight objects, cycles included, for good.
+@contextlib.contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
     try:
-        if os.path.exists('listings.json'):
-            with open('listings.json', 'r', encoding='utf-8') as f:
-                global listings
-                loaded_listings = json.load(f)
-                listings = {}
-                for k, v in loaded_listings.items():
-                    try:
-                        if v['category'] == "Calzado":
-                            logger.info(f"ℹ️ Skipping listing {k} with category 'Calzado'")
-                            if v['user_id'] in user_data and k in user_data[v['user_id']]['listings']:
-                                user_data[v['user_id']]['listings'].remove(k)
-                            continue
-                        city = v.get('city')
-                        if city in city_mapping.values():
-                            v['city'] = city
-                        else:
-                            for short, full in city_mapping.items():
-                                if city == short:
-                                    v['city'] = full
-                                    break
-                        posted_at = datetime.datetime.fromisoformat(v['posted_at'].replace('Z', '+00:00'))
-                        expires_at = datetime.datetime.fromisoformat(v['expires_at'].replace('Z', '+00:00'))
-                        if 'is_free' not in v:
-                            v['is_free'] = v['status'] == 'free'
-                        listings[k] = {
-                            **v,
-                            'posted_at': posted_at,
-                            'expires_at': expires_at
-                        }
-                    except (ValueError, KeyError) as e:
-                        logger.warning(f"⚠️ Skipping invalid listing {k}: {e}")
-                        continue
-            await save_user_data()
-            logger.info("✅ Listings loaded successfully.")
-        else:
-            logger.info("ℹ️ listings.json not found, starting with empty listings.")
+        yield
+    finally:
+        gc.freeze()
+        if enabled:
+            gc.enable()
+
+# Normalizes a listing read from disk in place; None for listings that are dropped
+def normalize_listing(listing_id, item):
+    if item['category'] == "Calzado":
+        logger.info(f"ℹ️ Skipping listing {listing_id} with category 'Calzado'")
+        if item['user_id'] in user_data and listing_id in user_data[item['user_id']]['listings']:
+            user_data[item['user_id']]['listings'].remove(listing_id)
+        return None
+    city = item.get('city')
+    if city not in city_mapping.values():
+        for short, full in city_mapping.items():
+            if city == short:
+                item['city'] = full
+                break
+    item['posted_at'] = datetime.datetime.fromisoformat(item['posted_at'].replace('Z', '+00:00'))
+    item['expires_at'] = datetime.datetime.fromisoformat(item['expires_at'].replace('Z', '+00:00'))
+    if 'is_free' not in item:
+        item['is_free'] = item['status'] == 'free'
+    if 'category_id' not in item:
+        item['category_id'] = category_ids_by_label.get(item['category'])
+    refresh_search_text(item)
+    return item
+
+def add_loaded_listing(listing_id, item):
+    try:
+        item = normalize_listing(listing_id, item)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"⚠️ Skipping invalid listing {listing_id}: {e}")
+        return
+    if item is None:
+        return
+    listings[listing_id] = item
+    keyword_index.add(listing_id, item)
+    filter_index.add(listing_id, item)
+    geo_index.add(listing_id, item)
+
+def rebuild_listing_indexes():
+    keyword_index.rebuild(listings)
+    filter_index.rebuild(listings)
+    geo_index.rebuild(listings)
+
+# Journal records replace or delete snapshot listings where they stand; listings only in the journal
+# are appended after the snapshot, in journal order. Returns False when the files could not be read.
+async def load_listings(pause_gc=True):
+    global listings, journal_record_count, journal_max_listing_id
+    journal_files = [path for path in (LISTINGS_JOURNAL_ROTATED_FILE, LISTINGS_JOURNAL_FILE) if os.path.exists(path)]
+    if not os.path.exists(LISTINGS_FILE) and not journal_files:
+        logger.info("ℹ️ listings.json not found, starting with empty listings.")
+        return True
+    try:
+        journal_ops, journal_record_count = await run_persistence(read_journal_files, journal_files)
+        journal_max_listing_id = max_listing_id(journal_ops)
+        if journal_record_count:
+            logger.info(f"📜 Replayed {journal_record_count} journal records.")
+        listings = {}
+        rebuild_listing_indexes()
+        with gc_paused() if pause_gc else contextlib.nullcontext():
+            if os.path.exists(LISTINGS_FILE):
+                reader = await run_persistence(ListingsFileReader, LISTINGS_FILE)
+                try:
+                    while batch := await run_persistence(reader.read_batch, LOAD_BATCH_SIZE):
+                        for listing_id, item in batch:
+                            if listing_id in journal_ops:
+                                item = journal_ops.pop(listing_id)
+                                if item is None:
+                                    continue
+                            add_loaded_listing(listing_id, item)
+                finally:
+                    await run_persistence(reader.close)
+            for listing_id, item in journal_ops.items():
+                if item is not None:
+                    add_loaded_listing(listing_id, item)
+        await save_user_data()
+        logger.info(f"✅ Listings loaded successfully ({len(listings)} listings).")
+        return True
     except json.JSONDecodeError as e:
         logger.error(f"❌ JSON decode error in listings.json: {e}")
         listings = {}
+        rebuild_listing_indexes()
     except Exception as e:
         logger.error(f"❌ Failed to load listings: {e}")
         listings = {}
+        rebuild_listing_indexes()
+    return False
 
-async def save_listings():
+def max_listing_id(listing_ids):
+    return max((int(listing_id) for listing_id in listing_ids if isinstance(listing_id, str) and listing_id.isdigit()), default=0)
+
+# Highest listing id ever handed out. The mark is saved before the listings that use its ids, so it
+# also covers deleted and archived listings; data from before the mark existed falls back to the archive.
+def read_last_listing_id():
+    try:
+        return int(read_json_file(LISTING_IDS_FILE)['last_listing_id'])
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"⚠️ Ignoring invalid {LISTING_IDS_FILE}: {e}")
+    archived_ids = []
+    if os.path.exists(LISTINGS_ARCHIVE_FILE):
+        with open(LISTINGS_ARCHIVE_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    archived_ids.append(json.loads(line)['id'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return max_listing_id(archived_ids)
+
+async def write_last_listing_id(value):
     try:
-        with open('listings.json', 'w', encoding='utf-8') as f:
-            json.dump(listings, f, ensure_ascii=False, indent=4, default=str)
+        await run_persistence(write_json_atomic, LISTING_IDS_FILE, {'last_listing_id': value})
+    except Exception as e:
+        logger.error(f"❌ Failed to save the listing id mark: {e}")
+
+def listings_journal_exists():
+    return os.path.exists(LISTINGS_JOURNAL_FILE) or os.path.exists(LISTINGS_JOURNAL_ROTATED_FILE)
+
+# The full snapshot already holds everything a leftover journal (from STORAGE_MODE=journal) recorded,
+# and replaying that journal over it on the next start would undo newer changes, so it goes
+def write_listings_file(snapshot):
+    write_json_atomic(LISTINGS_FILE, persisted_listings(snapshot), 4)
+    for path in (LISTINGS_JOURNAL_ROTATED_FILE, LISTINGS_JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+async def write_listings():
+    try:
+        await run_persistence(write_listings_file, snapshot_listings())
         logger.debug("💾 Listings saved.")
     except Exception as e:
         logger.error(f"❌ Failed to save listings: {e}")
 
-def generate_listing_id():
-    return str(len(listings) + 1)
-
-def count_listings_by_category():
-    counts = {category.replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', ''): 0 for category in categories}
-    counts['Gratis'] = 0
-    now = datetime.datetime.now()
-    for item in listings.values():
-        if item['expires_at'] > now:
-            if item.get('is_free', False):
-                counts['Gratis'] += 1
-            if item['category'].replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', '') in counts:
-                counts[item['category'].replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', '')] += 1
-    return counts
-
-def count_listings_by_city():
-    counts = {city: 0 for city in city_mapping.values()}
-    now = datetime.datetime.now()
-    for item in listings.values():
-        if item['expires_at'] > now and item['city'] in counts:
-            counts[item['city']] += 1
-    return counts
+def append_journal_records(records):
+    with open(LISTINGS_JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + '\n' for record in records))
+
+# Journals the current state of each listing; a listing missing from `listings` is journaled as deleted
+async def write_listing_records(listing_ids):
+    records = []
+    for listing_id in listing_ids:
+        item = listings.get(listing_id)
+        records.append({'op': 'put', 'id': listing_id, 'item': persisted_listing(item)} if item is not None else {'op': 'delete', 'id': listing_id})
+    note_journal_records(len(records))
+    try:
+        await run_persistence(append_journal_records, records)
+        logger.debug("📜 Journaled %d listing records.", len(records))
+    except Exception as e:
+        logger.error(f"❌ Failed to journal listings {', '.join(listing_ids)}: {e}")
+
+def note_journal_records(count):
+    global journal_record_count, journal_compaction_task
+    journal_record_count += count
+    if journal_record_count >= JOURNAL_COMPACT_THRESHOLD and (journal_compaction_task is None or journal_compaction_task.done()):
+        journal_compaction_task = asyncio.create_task(compact_listings_journal())
+
+def rotate_and_snapshot_listings(snapshot):
+    if os.path.exists(LISTINGS_JOURNAL_FILE):
+        if os.path.exists(LISTINGS_JOURNAL_ROTATED_FILE):
+            # A previous compaction did not finish; keep its records ahead of the current ones
+            with open(LISTINGS_JOURNAL_FILE, 'r', encoding='utf-8') as src, open(LISTINGS_JOURNAL_ROTATED_FILE, 'a', encoding='utf-8') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(LISTINGS_JOURNAL_FILE)
+        else:
+            os.replace(LISTINGS_JOURNAL_FILE, LISTINGS_JOURNAL_ROTATED_FILE)
+    write_json_atomic(LISTINGS_FILE, persisted_listings(snapshot))
+    if os.path.exists(LISTINGS_JOURNAL_ROTATED_FILE):
+        os.remove(LISTINGS_JOURNAL_ROTATED_FILE)
+
+# The snapshot is taken when the compaction job is queued; appends queued before it land in
+# the rotated journal and are already in the snapshot, so replaying them after a crash is harmless.
+async def compact_listings_journal():
+    global journal_record_count
+    try:
+        snapshot = snapshot_listings()
+        journal_record_count = 0
+        with metrics.timer(metrics.saves, "journal_compaction"):
+            await run_persistence(rotate_and_snapshot_listings, snapshot)
+        logger.info(f"🗜 Listings journal compacted into snapshot ({len(snapshot)} listings).")
+    except Exception as e:
+        logger.error(f"❌ Failed to compact listings journal: {e}")
+
+# ⏳ Write-behind saving: mutations only mark stores dirty, and one flush writes everything that
+# changed, at most once per SAVE_INTERVAL seconds or as soon as SAVE_MAX_PENDING mutations pile up.
+class SaveScheduler:
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.user_data_dirty = False
+        self.listings_dirty = False
+        self.dirty_listing_ids = set()
+        self.last_listing_id = None
+        self.pending = 0
+        self.timer_task = None
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+
+    async def mark_user_data(self):
+        self.user_data_dirty = True
+        await self.note_mutation()
+
+    async def mark_listing(self, listing_id):
+        if STORAGE_MODE == "journal":
+            self.dirty_listing_ids.add(listing_id)
+        else:
+            self.listings_dirty = True
+        await self.note_mutation()
+
+    async def mark_last_listing_id(self, value):
+        self.last_listing_id = value
+        await self.note_mutation()
+
+    async def note_mutation(self):
+        self.pending += 1
+        if self.interval <= 0:
+            await self.flush()
+        elif self.pending >= self.max_pending:
+            if self.flush_task is None or self.flush_task.done():
+                self.flush_task = asyncio.create_task(self.flush())
+        elif self.timer_task is None:
+            self.timer_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        self.timer_task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if self.timer_task is not None:
+                self.timer_task.cancel()
+                self.timer_task = None
+            listing_ids, self.dirty_listing_ids = self.dirty_listing_ids, set()
+            listings_dirty, self.listings_dirty = self.listings_dirty, False
+            user_data_dirty, self.user_data_dirty = self.user_data_dirty, False
+            last_listing_id, self.last_listing_id = self.last_listing_id, None
+            mutations, self.pending = self.pending, 0
+            if not mutations:
+                return
+            with metrics.timer(metrics.saves, "flush"):
+                # Before the listings, so no saved listing carries an id above the saved mark
+                if last_listing_id is not None:
+                    await write_last_listing_id(last_listing_id)
+                if listing_ids:
+                    await write_listing_records(sorted(listing_ids))
+                if listings_dirty:
+                    await write_listings()
+                if user_data_dirty:
+                    await write_user_data()
+            logger.debug("💾 Flushed %d pending mutations.", mutations)
+
+save_scheduler = SaveScheduler(SAVE_INTERVAL, SAVE_MAX_PENDING)
 
-async def display_item_card(chat_id, listing_id, message_id=None, caller_is_search=False, caller_is_edit=False, current_index=0, total_results=0):
-    item = listings.get(listing_id)
-    if not item:
-        logger.warning(f"⚠️ Attempt to display nonexistent listing ID: {listing_id}")
-        return
+async def save_user_data():
+    await save_scheduler.mark_user_data()
+
+async def save_listing(listing_id):
+    await save_scheduler.mark_listing(listing_id)
+
+# 🔎 Keyword index
+# token -> listing ids for whole words, plus every prefix of at least MIN_PREFIX_LENGTH characters
+# so that "sill" finds "silla". A query matches listings containing every query word as a word prefix.
+# Listings and queries are folded the same way, so "telefono" finds "Teléfono" and "banos" finds "Baños".
+MIN_PREFIX_LENGTH = 2
+EMPTY_POSTINGS = frozenset()
+
+def fold_text(text):
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+# Expects text that already went through fold_text()
+def tokenize_search_text(text):
+    return set(re.findall(r"\w+", text))
+
+# Folded title and description are stored on the listing once, instead of lowercasing them on every search
+def refresh_search_text(item):
+    item['search_text'] = fold_text(f"{item['title']} {item.get('description') or ''}")
+    return item['search_text']
+
+# Fields rebuilt from the rest of the listing on load; they stay out of every file and the `data` column
+DERIVED_LISTING_FIELDS = ('search_text',)
+
+def persisted_listing(item):
+    return {field: value for field, value in item.items() if field not in DERIVED_LISTING_FIELDS}
+
+def persisted_listings(records):
+    return {listing_id: persisted_listing(item) for listing_id, item in records.items()}
+
+# Folded title words, kept per listing so ranking never folds or tokenizes text per query
+def title_search_tokens(title):
+    return tuple(tokenize_search_text(fold_text(title)))
+
+def discard_posting(postings, key, listing_id):
+    ids = postings.get(key)
+    if ids is not None:
+        ids.discard(listing_id)
+        if not ids:
+            del postings[key]
+
+class KeywordIndex:
+    def __init__(self):
+        self.tokens = {}
+        self.prefixes = {}
+        self.listing_tokens = {}
+        self.title_tokens = {}
+
+    def add(self, listing_id, item):
+        self.title_tokens[listing_id] = title_search_tokens(item['title'])
+        self.add_tokens(listing_id, tokenize_search_text(item['search_text']))
+
+    def add_tokens(self, listing_id, tokens):
+        self.listing_tokens[listing_id] = tokens
+        for token in tokens:
+            self.tokens.setdefault(token, set()).add(listing_id)
+            for end in range(MIN_PREFIX_LENGTH, len(token) + 1):
+                self.prefixes.setdefault(token[:end], set()).add(listing_id)
+
+    def remove(self, listing_id):
+        self.title_tokens.pop(listing_id, None)
+        for token in self.listing_tokens.pop(listing_id, ()):
+            discard_posting(self.tokens, token, listing_id)
+            for end in range(MIN_PREFIX_LENGTH, len(token) + 1):
+                discard_posting(self.prefixes, token[:end], listing_id)
+
+    def update(self, listing_id, item):
+        tokens = tokenize_search_text(item['search_text'])
+        if tokens == self.listing_tokens.get(listing_id):
+            self.title_tokens[listing_id] = title_search_tokens(item['title'])
+            return
+        self.remove(listing_id)
+        self.title_tokens[listing_id] = title_search_tokens(item['title'])
+        self.add_tokens(listing_id, tokens)
+
+    def rebuild(self, items):
+        self.tokens, self.prefixes, self.listing_tokens, self.title_tokens = {}, {}, {}, {}
+        for listing_id, item in items.items():
+            self.add(listing_id, item)
+
+    def lookup(self, term):
+        if len(term) < MIN_PREFIX_LENGTH:
+            return self.tokens.get(term, EMPTY_POSTINGS)
+        return self.prefixes.get(term, EMPTY_POSTINGS)
+
+    # Returns None when the keyword has no searchable words, i.e. it should not filter at all
+    def search(self, keyword):
+        terms = tokenize_search_text(fold_text(keyword))
+        if not terms:
+            return None
+        postings = sorted((self.lookup(term) for term in terms), key=len)
+        matches = set(postings[0])
+        for ids in postings[1:]:
+            if not matches:
+                break
+            matches &= ids
+        return matches
+
+keyword_index = KeywordIndex()
+
+# 🧭 Filter indexes for the search wizard: city -> ids, category id -> ids, and the free ids.
+# The set sizes double as the live counters shown on the search keyboards.
+def listing_filter_keys(item):
+    return (item.get('city') or '', item.get('category_id'), bool(item.get('is_free', False)))
+
+class FilterIndex:
+    def __init__(self):
+        self.by_city = {}
+        self.by_category = {}
+        self.free = set()
+        self.listing_keys = {}
+
+    def add(self, listing_id, item):
+        keys = listing_filter_keys(item)
+        self.listing_keys[listing_id] = keys
+        city, category, is_free = keys
+        self.by_city.setdefault(city, set()).add(listing_id)
+        self.by_category.setdefault(category, set()).add(listing_id)
+        if is_free:
+            self.free.add(listing_id)
+
+    def remove(self, listing_id):
+        keys = self.listing_keys.pop(listing_id, None)
+        if keys is None:
+            return
+        city, category, is_free = keys
+        discard_posting(self.by_city, city, listing_id)
+        discard_posting(self.by_category, category, listing_id)
+        self.free.discard(listing_id)
+
+    def update(self, listing_id, item):
+        if self.listing_keys.get(listing_id) == listing_filter_keys(item):
+            return
+        self.remove(listing_id)
+        self.add(listing_id, item)
+
+    def rebuild(self, items):
+        self.by_city, self.by_category, self.free, self.listing_keys = {}, {}, set(), {}
+        for listing_id, item in items.items():
+            self.add(listing_id, item)
+
+filter_index = FilterIndex()
+
+# Per-key listing counts for backends without in-memory id sets; updated by deltas on every mutation
+class ListingCounters:
+    def __init__(self):
+        self.by_city = collections.Counter()
+        self.by_category = collections.Counter()
+        self.free = 0
+
+    def add(self, keys, delta=1):
+        city, category, is_free = keys
+        self.by_city[city] += delta
+        self.by_category[category] += delta
+        if is_free:
+            self.free += delta
+
+# Collects the id set of every active filter and intersects them smallest first, so the cost
+# follows the most selective filter. Returns None when nothing filters, meaning "all listings".
+def plan_search(keyword, category, city):
+    filters = []
+    if keyword:
+        keyword_matches = keyword_index.search(keyword)
+        if keyword_matches is not None:
+            filters.append(('keyword', keyword_matches))
+    if category == FREE_CATEGORY_ID:
+        filters.append(('free', filter_index.free))
+    elif category is not None:
+        filters.append(('category', filter_index.by_category.get(category, EMPTY_POSTINGS)))
+    if city:
+        filters.append(('city', filter_index.by_city.get(city, EMPTY_POSTINGS)))
+    if not filters:
+        return None
+    filters.sort(key=lambda named_ids: len(named_ids[1]))
+    if trace_logger.isEnabledFor(logging.DEBUG):
+        trace_logger.debug("🧭 Search plan: %s", ', '.join(f'{name}={len(ids)}' for name, ids in filters))
+    matches = set(filters[0][1])
+    for _, ids in filters[1:]:
+        if not matches:
+            break
+        matches &= ids
+    return matches
+
+# 🏅 Relevance ranking: each match gets a score from its keyword hits (title words weigh more than
+# description words), its age, how close it is to expiring and the free flag. Matches go into a heap
+# and are popped in order only as far as a page needs, so a large result set never gets fully sorted.
+RANK_TITLE_WEIGHT = 3.0
+RANK_DESCRIPTION_WEIGHT = 1.0
+RANK_FREE_WEIGHT = 2.0
+# Bonus of a brand-new listing, decaying by e every RANK_RECENCY_DAYS
+RANK_RECENCY_WEIGHT = 1.0
+RANK_RECENCY_DAYS = 3.0
+# Bonus growing over the last RANK_EXPIRY_DAYS before expiry, so last-chance listings surface
+RANK_EXPIRY_WEIGHT = 0.5
+RANK_EXPIRY_DAYS = 1.0
+
+# Only scores keyword matches: every term already prefixes a word of the title or the description,
+# so a term that prefixes no title word is in the description
+def keyword_score(terms, title_tokens):
+    score = 0.0
+    for term in terms:
+        if any(token.startswith(term) for token in title_tokens):
+            score += RANK_TITLE_WEIGHT
+        else:
+            score += RANK_DESCRIPTION_WEIGHT
+    return score
+
+# Ages and remaining lifetimes are in days
+def listing_score(terms, title_tokens, age_days, days_left, is_free):
+    return (
+        keyword_score(terms, title_tokens)
+        + (RANK_FREE_WEIGHT if is_free else 0.0)
+        + RANK_RECENCY_WEIGHT * math.exp(-max(age_days, 0.0) / RANK_RECENCY_DAYS)
+        + RANK_EXPIRY_WEIGHT * max(0.0, 1.0 - days_left / RANK_EXPIRY_DAYS)
+    )
+
+# Read-only sequence of listing ids, best first, built from (score, tiebreak, listing_id) entries.
+# Equal scores keep the tiebreak order (insertion order of the listings).
+class RankedResults:
+    def __init__(self, scored):
+        self.heap = [(-score, tiebreak, listing_id) for score, tiebreak, listing_id in scored]
+        heapq.heapify(self.heap)
+        self.ordered = []
+        self.total = len(self.heap)
+
+    def __len__(self):
+        return self.total
+
+    def ensure(self, count):
+        while len(self.ordered) < count and self.heap:
+            self.ordered.append(heapq.heappop(self.heap)[2])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.total)
+            self.ensure(max(start, stop) + (1 if step < 0 else 0))
+            return self.ordered[index]
+        if index < 0:
+            index += self.total
+        if not 0 <= index < self.total:
+            raise IndexError("ranked result index out of range")
+        self.ensure(index + 1)
+        return self.ordered[index]
+
+    def __iter__(self):
+        for index in range(self.total):
+            yield self[index]
+
+# 🗂 Search result cache: each materialized result list is stored once, under a token, and shared by
+# every session that ran the same normalized query. Sessions keep only the query and the token in
+# their FSM data, so paging reads a shared result list. A listing change retires the live token of every
+# query whose city and category filters match the listing before or after the change; sessions
+# already paging keep their snapshot until it is evicted, then the query is re-run.
+# Every query key starts with its kind, so no keyword can make a keyword query look like another kind.
+KEYWORD_QUERY = "keyword"
+
+def search_query_key(keyword, category, city):
+    return (KEYWORD_QUERY, ' '.join(sorted(tokenize_search_text(fold_text(keyword or '')))), category, city or '')
+
+# Whether a listing with these filter keys can appear in the query's results (keywords aside)
+def query_matches_keys(query, keys):
+    if query[0] == NEARBY_QUERY:
+        # Filter keys carry no position, so any change may move a listing into or out of range
+        return True
+    _, _, category, city = query
+    listing_city, listing_category, is_free = keys
+    if city and city != listing_city:
+        return False
+    if category == FREE_CATEGORY_ID:
+        return is_free
+    return category is None or category == listing_category
+
+class SearchResultCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshots = collections.OrderedDict()
+        self.live = {}
+        self.version = 0
+        self.tokens = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query):
+        token, stored_at = self.live.get(query, (None, 0.0))
+        if token not in self.snapshots or time.monotonic() - stored_at > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.snapshots.move_to_end(token)
+        return token, self.snapshots[token][1]
+
+    # Results computed before an invalidation are still handed to their session, but never become live
+    def store(self, query, ids, version):
+        token = next(self.tokens)
+        if not isinstance(ids, RankedResults):
+            ids = tuple(ids)
+        self.snapshots[token] = (query, ids)
+        if version == self.version:
+            self.live[query] = (token, time.monotonic())
+        while len(self.snapshots) > self.max_size:
+            evicted, (evicted_query, _) = self.snapshots.popitem(last=False)
+            if self.live.get(evicted_query, (None,))[0] == evicted:
+                del self.live[evicted_query]
+        return token, ids
+
+    # Tokens restart after a restart, so a snapshot only counts if it belongs to the same query
+    def snapshot(self, token, query):
+        entry = self.snapshots.get(token)
+        if entry is None or entry[0] != query:
+            return None
+        self.snapshots.move_to_end(token)
+        return entry[1]
+
+    # `keys` are the filter keys of the touched listings; None entries (unknown old state) are skipped
+    def invalidate(self, keys):
+        keys = [listing_keys for listing_keys in keys if listing_keys is not None]
+        self.version += 1
+        stale = [query for query in self.live if any(query_matches_keys(query, listing_keys) for listing_keys in keys)]
+        for query in stale:
+            del self.live[query]
+        if stale:
+            logger.debug("🗂 Invalidated %d cached searches.", len(stale))
+
+search_cache = SearchResultCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+# 🖼 Rendered item cards, LRU by listing. Each listing keeps the cards of a single version (bumped by
+# update_listing) and one card per view mode; a newer version replaces them all. Deleted or expired
+# listings are discarded explicitly, since their id may be handed out again.
+class CardCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.cards = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, listing_id, version, mode):
+        entry = self.cards.get(listing_id)
+        card = entry[1].get(mode) if entry is not None and entry[0] == version else None
+        if card is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cards.move_to_end(listing_id)
+        return card
+
+    def put(self, listing_id, version, mode, card):
+        entry = self.cards.get(listing_id)
+        if entry is None or entry[0] != version:
+            entry = self.cards[listing_id] = (version, {})
+        entry[1][mode] = card
+        self.cards.move_to_end(listing_id)
+        while len(self.cards) > self.max_size:
+            self.cards.popitem(last=False)
+
+    def discard(self, listing_id):
+        self.cards.pop(listing_id, None)
+
+card_cache = CardCache(CARD_CACHE_SIZE)
+
+# 🌍 Geo index: listings with coordinates are bucketed into a GEO_CELL_DEGREES grid, so a radius
+# query only measures distances to listings in the cells overlapping the circle's bounding box.
+GEO_CELL_DEGREES = 0.1
+EARTH_RADIUS_KM = 6371.0
+# Query key of a nearby search; the point is rounded (about 100 m) so nearby users share results
+NEARBY_QUERY = "nearby"
+
+def nearby_query_key(latitude, longitude):
+    return (NEARBY_QUERY, round(latitude, 3), round(longitude, 3))
+
+def listing_coordinates(item):
+    if item.get('latitude') is None or item.get('longitude') is None:
+        return None
+    return float(item['latitude']), float(item['longitude'])
+
+def geo_cell(latitude, longitude):
+    return int((latitude + 90) // GEO_CELL_DEGREES) * 10000 + int((longitude + 180) // GEO_CELL_DEGREES)
+
+def geo_cells_around(latitude, longitude, radius_km):
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 0.01)
+    lat_cells = range(int((max(latitude - lat_delta, -90) + 90) // GEO_CELL_DEGREES), int((min(latitude + lat_delta, 90) + 90) // GEO_CELL_DEGREES) + 1)
+    lon_cells = range(int((longitude - lon_delta + 180) // GEO_CELL_DEGREES), int((longitude + lon_delta + 180) // GEO_CELL_DEGREES) + 1)
+    return [lat_cell * 10000 + lon_cell for lat_cell in lat_cells for lon_cell in lon_cells]
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+# Ids within the radius, nearest first, from (listing_id, latitude, longitude) candidates
+def rank_by_distance(candidates, latitude, longitude, radius_km):
+    distances = []
+    for listing_id, listing_latitude, listing_longitude in candidates:
+        distance = haversine_km(latitude, longitude, listing_latitude, listing_longitude)
+        if distance <= radius_km:
+            distances.append((distance, listing_id))
+    distances.sort()
+    return [listing_id for _, listing_id in distances]
+
+class GeoIndex:
+    def __init__(self):
+        self.cells = {}
+        self.points = {}
+
+    def add(self, listing_id, item):
+        coordinates = listing_coordinates(item)
+        if coordinates is None:
+            return
+        cell = geo_cell(*coordinates)
+        self.points[listing_id] = (*coordinates, cell)
+        self.cells.setdefault(cell, set()).add(listing_id)
+
+    def remove(self, listing_id):
+        point = self.points.pop(listing_id, None)
+        if point is not None:
+            discard_posting(self.cells, point[2], listing_id)
+
+    def update(self, listing_id, item):
+        self.remove(listing_id)
+        self.add(listing_id, item)
+
+    def rebuild(self, items):
+        self.cells, self.points = {}, {}
+        for listing_id, item in items.items():
+            self.add(listing_id, item)
+
+    def nearby(self, latitude, longitude, radius_km):
+        candidates = (
+            (listing_id, *self.points[listing_id][:2])
+            for cell in geo_cells_around(latitude, longitude, radius_km)
+            for listing_id in self.cells.get(cell, EMPTY_POSTINGS)
+        )
+        return rank_by_distance(candidates, latitude, longitude, radius_km)
+
+geo_index = GeoIndex()
+
+# ⏰ Expiry queue: a min-heap of (expires_at, listing_id). Rescheduling or cancelling a listing
+# leaves its old entry in the heap; `current` tells live entries from stale ones when they surface.
+class ExpiryQueue:
+    def __init__(self):
+        self.heap = []
+        self.current = {}
+
+    def schedule(self, listing_id, expires_at):
+        if self.current.get(listing_id) == expires_at:
+            return
+        self.current[listing_id] = expires_at
+        heapq.heappush(self.heap, (expires_at, listing_id))
+        if len(self.heap) > 2 * len(self.current) + 64:
+            self.rebuild(self.current)
+
+    def cancel(self, listing_id):
+        self.current.pop(listing_id, None)
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, listing_id = heapq.heappop(self.heap)
+            if self.current.get(listing_id) == expires_at:
+                del self.current[listing_id]
+                due.append(listing_id)
+        return due
+
+    def rebuild(self, expiry_times):
+        self.current = dict(expiry_times)
+        self.heap = [(expires_at, listing_id) for listing_id, expires_at in self.current.items()]
+        heapq.heapify(self.heap)
+
+expiry_queue = ExpiryQueue()
+
+def append_archive_records(items):
+    with open(LISTINGS_ARCHIVE_FILE, 'a', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(persisted_listing(item), ensure_ascii=False, separators=(',', ':'), default=str) + '\n' for item in items))
+
+# 🗄 Storage backends
+# Handlers only talk to `storage`; JsonStorage keeps everything in the `listings` and `user_data`
+# dicts persisted as JSON files, SqliteStorage keeps it in an indexed SQLite database.
+class ListingStorage(abc.ABC):
+    @abc.abstractmethod
+    async def load(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def flush(self):
+        raise NotImplementedError
+
+    async def close(self):
+        await self.flush()
+
+    @abc.abstractmethod
+    async def get_user(self, user_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def create_user(self, user_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_listing(self, listing_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_listings(self, listing_ids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def create_listing(self, item):
+        raise NotImplementedError
+
+    # Returns False, without saving, when the listing no longer exists
+    @abc.abstractmethod
+    async def update_listing(self, item):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete_listing(self, listing_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def generate_listing_id(self):
+        raise NotImplementedError
+
+    # Applies listing changes made by other processes; backends without shared state have none
+    async def sync_changes(self):
+        return 0
+
+    @abc.abstractmethod
+    async def search_listings(self, keyword, category, city, now):
+        raise NotImplementedError
+
+    # Live listings with coordinates within radius_km of the point, nearest first
+    @abc.abstractmethod
+    async def search_nearby(self, latitude, longitude, radius_km, now):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def active_user_listings(self, user_id, now):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def count_listings_by_category(self, now):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def count_listings_by_city(self, now):
+        raise NotImplementedError
+
+    # Moves listings whose expires_at has passed out of the active set into the archive
+    @abc.abstractmethod
+    async def expire_listings(self, now):
+        raise NotImplementedError
+
+class JsonStorage(ListingStorage):
+    def __init__(self):
+        # Insertion order of listings, so index lookups can return results in the same order a full scan would;
+        # positions only grow, so a listing created after a delete never shares one with a live listing
+        self.positions = {}
+        self.next_position = itertools.count()
+        self.last_listing_id = 0
+        # Set once listings are in memory; every listing access waits for it
+        self.loaded = asyncio.Event()
+        self.load_task = None
+
+    async def load(self):
+        await load_user_data()
+        if LISTINGS_BACKGROUND_LOAD:
+            self.load_task = asyncio.create_task(self.load_listings(background=True))
+        else:
+            await self.load_listings()
+
+    async def load_listings(self, background=False):
+        started = time.perf_counter()
+        journaled = listings_journal_exists()
+        try:
+            loaded = await load_listings(pause_gc=not background)
+            self.positions = {listing_id: position for position, listing_id in enumerate(listings)}
+            self.next_position = itertools.count(len(self.positions))
+            self.last_listing_id = max(max_listing_id(listings), journal_max_listing_id, await run_persistence(read_last_listing_id))
+            expiry_queue.rebuild({listing_id: item['expires_at'] for listing_id, item in listings.items()})
+        finally:
+            self.loaded.set()
+        logger.info(f"📥 Listings ready in {time.perf_counter() - started:.2f}s.")
+        await self.expire_listings(datetime.datetime.now())
+        # Journals are folded into the snapshot on every start, whatever STORAGE_MODE is: a json-mode run
+        # never appends to them, so replaying them on a later start would undo its changes.
+        # After a failed load the snapshot would be empty, so the files are left as they are.
+        if loaded and journaled:
+            await compact_listings_journal()
+
+    async def close(self):
+        if self.load_task is not None and not self.load_task.done():
+            self.load_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.load_task
+        await self.flush()
+
+    async def flush(self):
+        await save_scheduler.flush()
+        if journal_compaction_task is not None:
+            await journal_compaction_task
+
+    async def get_user(self, user_id):
+        return user_data.get(user_id)
+
+    async def create_user(self, user_id):
+        user = user_data.setdefault(user_id, {"listings": [], "favorites": [], "banned": False})
+        await save_user_data()
+        return user
+
+    async def get_listing(self, listing_id):
+        await self.loaded.wait()
+        return listings.get(listing_id)
+
+    async def get_listings(self, listing_ids):
+        await self.loaded.wait()
+        return {listing_id: listings[listing_id] for listing_id in listing_ids if listing_id in listings}
+
+    async def create_listing(self, item):
+        await self.loaded.wait()
+        card_cache.discard(item['id'])
+        refresh_search_text(item)
+        listings[item['id']] = item
+        self.positions[item['id']] = next(self.next_position)
+        keyword_index.add(item['id'], item)
+        filter_index.add(item['id'], item)
+        geo_index.add(item['id'], item)
+        expiry_queue.schedule(item['id'], item['expires_at'])
+        search_cache.invalidate([filter_index.listing_keys[item['id']]])
+        user = user_data.setdefault(item['user_id'], {"listings": [], "favorites": [], "banned": False})
+        user['listings'].append(item['id'])
+        await save_listing(item['id'])
+        await save_user_data()
+
+    async def update_listing(self, item):
+        await self.loaded.wait()
+        if item['id'] not in listings:
+            return False
+        item['version'] = item.get('version', 0) + 1
+        refresh_search_text(item)
+        listings[item['id']] = item
+        old_keys = filter_index.listing_keys.get(item['id'])
+        keyword_index.update(item['id'], item)
+        filter_index.update(item['id'], item)
+        geo_index.update(item['id'], item)
+        expiry_queue.schedule(item['id'], item['expires_at'])
+        search_cache.invalidate([old_keys, filter_index.listing_keys[item['id']]])
+        await save_listing(item['id'])
+        return True
+
+    def remove_listing(self, listing_id):
+        item = listings.pop(listing_id, None)
+        if item is None:
+            return None
+        search_cache.invalidate([filter_index.listing_keys.get(listing_id)])
+        card_cache.discard(listing_id)
+        keyword_index.remove(listing_id)
+        filter_index.remove(listing_id)
+        geo_index.remove(listing_id)
+        expiry_queue.cancel(listing_id)
+        self.positions.pop(listing_id, None)
+        user = user_data.get(item['user_id'])
+        if user and listing_id in user['listings']:
+            user['listings'].remove(listing_id)
+        return item
+
+    async def delete_listing(self, listing_id):
+        await self.loaded.wait()
+        item = self.remove_listing(listing_id)
+        if item is None:
+            return None
+        await save_listing(listing_id)
+        await save_user_data()
+        return item
+
+    # Cheap when nothing is due (one heap peek), so every read path calls it first and can
+    # then treat everything left in `listings` as live.
+    async def expire_listings(self, now):
+        await self.loaded.wait()
+        due = expiry_queue.pop_due(now)
+        if not due:
+            return 0
+        archived = [item for item in map(self.remove_listing, due) if item is not None]
+        try:
+            await run_persistence(append_archive_records, archived)
+        except Exception as e:
+            logger.error(f"❌ Failed to archive expired listings: {e}")
+        for item in archived:
+            await save_listing(item['id'])
+        await save_user_data()
+        logger.info(f"🗃 Archived {len(archived)} expired listings.")
+        return len(archived)
+
+    # Ids only grow, and the highest one is saved, so a deleted or archived listing's id is never handed out again
+    async def generate_listing_id(self):
+        await self.loaded.wait()
+        self.last_listing_id += 1
+        await save_scheduler.mark_last_listing_id(self.last_listing_id)
+        return str(self.last_listing_id)
+
+    async def search_listings(self, keyword, category, city, now):
+        await self.expire_listings(now)
+        matches = plan_search(keyword, category, city)
+        terms = tokenize_search_text(fold_text(keyword)) if keyword else set()
+        scored = []
+        title_tokens = keyword_index.title_tokens
+        for listing_id in (listings if matches is None else matches):
+            item = listings[listing_id]
+            score = listing_score(
+                terms, title_tokens[listing_id],
+                (now - item['posted_at']).total_seconds() / 86400, (item['expires_at'] - now).total_seconds() / 86400,
+                item.get('is_free', False)
+            )
+            scored.append((score, self.positions[listing_id], listing_id))
+        return RankedResults(scored)
+
+    async def search_nearby(self, latitude, longitude, radius_km, now):
+        await self.expire_listings(now)
+        return geo_index.nearby(latitude, longitude, radius_km)
+
+    async def active_user_listings(self, user_id, now):
+        await self.expire_listings(now)
+        user = user_data.get(user_id)
+        if not user:
+            return []
+        return [listings[lid] for lid in user.get('listings', []) if lid in listings]
+
+    async def count_listings_by_category(self, now):
+        await self.expire_listings(now)
+        counts = {category_id: len(filter_index.by_category.get(category_id, EMPTY_POSTINGS)) for category_id in category_ids}
+        counts[FREE_CATEGORY_ID] = len(filter_index.free)
+        return counts
+
+    async def count_listings_by_city(self, now):
+        await self.expire_listings(now)
+        return {city: len(filter_index.by_city.get(city, EMPTY_POSTINGS)) for city in city_mapping.values()}
+
+def format_db_datetime(value):
+    return value.isoformat(sep=' ', timespec='microseconds')
+
+def parse_listing_datetimes(item):
+    item['posted_at'] = datetime.datetime.fromisoformat(item['posted_at'])
+    item['expires_at'] = datetime.datetime.fromisoformat(item['expires_at'])
+    return item
+
+# SQLite in WAL mode with one connection that is only ever used from the persistence thread,
+# so statements are serialized without extra locking and never block the event loop.
+# The full listing is kept as JSON in `data`; the filtered columns are duplicated and indexed.
+class SqliteStorage(ListingStorage):
+    schema = [
+        """CREATE TABLE IF NOT EXISTS listings (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            category_id INTEGER,
+            city TEXT NOT NULL DEFAULT '',
+            is_free INTEGER NOT NULL DEFAULT 0,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL DEFAULT '',
+            title_terms TEXT NOT NULL DEFAULT '',
+            posted_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            data TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL,
+            geo_cell INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_listings_expires_at ON listings(expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_listings_city ON listings(city, expires_at)",
+        "DROP INDEX IF EXISTS idx_listings_category",
+        "CREATE INDEX IF NOT EXISTS idx_listings_category_id ON listings(category_id, expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_listings_is_free ON listings(is_free, expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_listings_user_id ON listings(user_id, expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_listings_geo_cell ON listings(geo_cell, expires_at)",
+        # One row per (word prefix, listing), so keyword search is an index range scan per query word
+        """CREATE TABLE IF NOT EXISTS listing_terms (
+            term TEXT NOT NULL,
+            listing_id TEXT NOT NULL,
+            PRIMARY KEY (term, listing_id)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_listing_terms_listing_id ON listing_terms(listing_id)",
+        """CREATE TABLE IF NOT EXISTS archived_listings (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            expires_at TEXT NOT NULL,
+            archived_at TEXT NOT NULL,
+            data TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            banned INTEGER NOT NULL DEFAULT 0,
+            favorites TEXT NOT NULL DEFAULT '[]'
+        )""",
+        # Listing ids come from an atomic counter, never from the current row count
+        """CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )""",
+        # Every listing mutation with the filter keys it touched, read by the other workers
+        """CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            worker INTEGER NOT NULL,
+            listing_id TEXT NOT NULL,
+            filter_keys TEXT NOT NULL
+        )""",
+    ]
+    # Moves the listing id counter past every id in use or archived; run after opening and after imports
+    sync_sequence_sql = """
+        INSERT INTO sequences (name, value)
+        SELECT 'listings', COALESCE(MAX(CAST(id AS INTEGER)), 0) FROM (SELECT id FROM listings UNION ALL SELECT id FROM archived_listings) WHERE true
+        ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+    """
+    change_log_keep = 10000
+    upsert_listing_sql = """
+        INSERT INTO listings (id, user_id, category, category_id, city, is_free, title, description, title_terms, posted_at, expires_at, data, latitude, longitude, geo_cell)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            user_id = excluded.user_id, category = excluded.category, category_id = excluded.category_id, city = excluded.city,
+            is_free = excluded.is_free, title = excluded.title, description = excluded.description, title_terms = excluded.title_terms,
+            posted_at = excluded.posted_at, expires_at = excluded.expires_at, data = excluded.data,
+            latitude = excluded.latitude, longitude = excluded.longitude, geo_cell = excluded.geo_cell
+    """
+    # Columns added after the first release, created on older databases before the schema runs
+    added_columns = [
+        ("category_id", "INTEGER"), ("latitude", "REAL"), ("longitude", "REAL"), ("geo_cell", "INTEGER"),
+        ("title_terms", "TEXT NOT NULL DEFAULT ''"),
+    ]
+
+    schema_version = 6
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.counters = ListingCounters()
+        self.next_expiry = datetime.datetime.min
+        self.worker_id = os.getpid()
+        self.change_seq = 0
+
+    def open_sync(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(listings)")]
+            for column, column_type in self.added_columns:
+                if columns and column not in columns:
+                    self.conn.execute(f"ALTER TABLE listings ADD COLUMN {column} {column_type}")
+            for statement in self.schema:
+                self.conn.execute(statement)
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 6:
+                # Rows written before derived fields were stripped carry them inside `data`
+                for field in DERIVED_LISTING_FIELDS:
+                    self.conn.execute(f"UPDATE listings SET data = json_remove(data, '$.{field}') WHERE json_type(data, '$.{field}') IS NOT NULL")
+            if version < 5:
+                # Folded title words for ranking, space-separated
+                self.conn.executemany(
+                    "UPDATE listings SET title_terms = ? WHERE id = ?",
+                    [(' '.join(title_search_tokens(title)), listing_id) for listing_id, title in self.conn.execute("SELECT id, title FROM listings").fetchall()]
+                )
+            if version < 4:
+                # Databases from before the geo index keep coordinates only inside `data`
+                rows = self.conn.execute(
+                    "SELECT id, json_extract(data, '$.latitude'), json_extract(data, '$.longitude') FROM listings "
+                    "WHERE json_extract(data, '$.latitude') IS NOT NULL AND json_extract(data, '$.longitude') IS NOT NULL"
+                ).fetchall()
+                self.conn.executemany(
+                    "UPDATE listings SET latitude = ?, longitude = ?, geo_cell = ? WHERE id = ?",
+                    [(latitude, longitude, geo_cell(latitude, longitude), listing_id) for listing_id, latitude, longitude in rows]
+                )
+            if version < 3:
+                # Databases from before the category registry only have the label
+                self.conn.executemany(
+                    "UPDATE listings SET category_id = ?, data = json_set(data, '$.category_id', ?) WHERE category = ? AND category_id IS NULL",
+                    [(category_id, category_id, label) for label, category_id in category_ids_by_label.items()]
+                )
+            if version < 2:
+                # Databases from before listing_terms, or before folded terms, need their terms rebuilt
+                self.conn.execute("DELETE FROM listing_terms")
+                for listing_id, title, description in self.conn.execute("SELECT id, title, description FROM listings").fetchall():
+                    self.conn.executemany("INSERT INTO listing_terms (term, listing_id) VALUES (?, ?)", self.term_rows(listing_id, fold_text(f"{title} {description}")))
+            self.conn.execute(f"PRAGMA user_version = {self.schema_version}")
+        return self.conn.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+
+    def change_statement(self, listing_id, keys):
+        return (
+            "INSERT INTO change_log (worker, listing_id, filter_keys) VALUES (?, ?, ?)",
+            (self.worker_id, listing_id, json.dumps([list(listing_keys) for listing_keys in keys if listing_keys is not None]))
+        )
+
+    def load_counters_sync(self):
+        counters = ListingCounters()
+        for city, category_id, is_free, count in self.conn.execute("SELECT city, category_id, is_free, COUNT(*) FROM listings GROUP BY city, category_id, is_free"):
+            counters.add(listing_filter_keys({'city': city, 'category_id': category_id, 'is_free': is_free}), count)
+        return counters
+
+    def term_rows(self, listing_id, text):
+        terms = set()
+        for token in tokenize_search_text(text):
+            terms.add(token)
+            terms.update(token[:end] for end in range(MIN_PREFIX_LENGTH, len(token)))
+        return [(term, listing_id) for term in terms]
+
+    def listing_statements(self, item):
+        refresh_search_text(item)
+        return [
+            (self.upsert_listing_sql, self.listing_row(item)),
+            ("DELETE FROM listing_terms WHERE listing_id = ?", (item['id'],)),
+            *(("INSERT INTO listing_terms (term, listing_id) VALUES (?, ?)", row) for row in self.term_rows(item['id'], item['search_text'])),
+        ]
+
+    def query_sync(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+    def execute_sync(self, statements):
+        with self.conn:
+            for sql, params in statements:
+                self.conn.execute(sql, params)
+
+    def executemany_sync(self, sql, rows):
+        with self.conn:
+            self.conn.executemany(sql, rows)
+
+    async def query(self, sql, params=()):
+        return await run_persistence(self.query_sync, sql, params)
+
+    async def execute(self, *statements):
+        with metrics.timer(metrics.saves, "sqlite_write"):
+            await run_persistence(self.execute_sync, statements)
+
+    def listing_row(self, item):
+        coordinates = listing_coordinates(item)
+        return (
+            item['id'], item['user_id'], item['category'], item.get('category_id'), item.get('city') or '', int(bool(item.get('is_free', False))),
+            item['title'], item.get('description') or '', ' '.join(title_search_tokens(item['title'])), format_db_datetime(item['posted_at']),
+            format_db_datetime(item['expires_at']), json.dumps(persisted_listing(item), ensure_ascii=False, separators=(',', ':'), default=str),
+            *(coordinates or (None, None)), geo_cell(*coordinates) if coordinates else None
+        )
+
+    async def load(self):
+        listing_count = await run_persistence(self.open_sync)
+        logger.info(f"✅ SQLite storage opened: {self.path} ({listing_count} listings).")
+        if listing_count == 0 and (os.path.exists(LISTINGS_FILE) or listings_journal_exists()):
+            await self.import_json()
+        await self.execute((self.sync_sequence_sql, ()))
+        rows = await self.query("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+        self.change_seq = rows[0][0]
+        self.counters = await run_persistence(self.load_counters_sync)
+        await self.expire_listings(datetime.datetime.now())
+
+    # One-time migration from the JSON files, reusing the JSON loader and its normalization
+    async def import_json(self):
+        global listings, user_data
+        await load_user_data()
+        await load_listings()
+        await run_persistence(self.executemany_sync, self.upsert_listing_sql, [self.listing_row(item) for item in listings.values()])
+        await run_persistence(
+            self.executemany_sync,
+            "INSERT OR IGNORE INTO listing_terms (term, listing_id) VALUES (?, ?)",
+            [row for listing_id, item in listings.items() for row in self.term_rows(listing_id, item['search_text'])]
+        )
+        await run_persistence(
+            self.executemany_sync,
+            "INSERT OR IGNORE INTO users (user_id, banned, favorites) VALUES (?, ?, ?)",
+            [(user_id, int(bool(user.get('banned', False))), json.dumps(user.get('favorites', []))) for user_id, user in user_data.items()]
+        )
+        # Deleted and archived JSON listings are not imported, but favorites may still hold their ids
+        last_listing_id = max(journal_max_listing_id, await run_persistence(read_last_listing_id))
+        await self.execute((
+            "INSERT INTO sequences (name, value) VALUES ('listings', ?) ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+            (last_listing_id,)
+        ))
+        logger.info(f"📥 Imported {len(listings)} listings and {len(user_data)} users from JSON into SQLite.")
+        listings, user_data = {}, {}
+        rebuild_listing_indexes()
+        expiry_queue.rebuild({})
+
+    async def flush(self):
+        pass
+
+    def close_sync(self):
+        # Refreshes the statistics SQLite's planner uses to pick the most selective index
+        self.conn.execute("PRAGMA optimize")
+        self.conn.close()
+
+    async def close(self):
+        if self.conn is not None:
+            await run_persistence(self.close_sync)
+            self.conn = None
+
+    async def get_user(self, user_id):
+        rows = await self.query("SELECT banned, favorites FROM users WHERE user_id = ?", (user_id,))
+        if not rows:
+            return None
+        return {"favorites": json.loads(rows[0][1]), "banned": bool(rows[0][0])}
+
+    async def create_user(self, user_id):
+        await self.execute(("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)))
+        return await self.get_user(user_id)
+
+    async def get_listing(self, listing_id):
+        rows = await self.query("SELECT data FROM listings WHERE id = ?", (listing_id,))
+        return parse_listing_datetimes(json.loads(rows[0][0])) if rows else None
+
+    async def get_listings(self, listing_ids):
+        listing_ids = list(listing_ids)
+        if not listing_ids:
+            return {}
+        placeholders = ','.join('?' * len(listing_ids))
+        rows = await self.query(f"SELECT id, data FROM listings WHERE id IN ({placeholders})", listing_ids)
+        return {listing_id: parse_listing_datetimes(json.loads(data)) for listing_id, data in rows}
+
+    async def create_listing(self, item):
+        card_cache.discard(item['id'])
+        await self.execute(
+            ("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (item['user_id'],)),
+            *self.listing_statements(item),
+            self.change_statement(item['id'], [listing_filter_keys(item)])
+        )
+        self.counters.add(listing_filter_keys(item))
+        self.next_expiry = min(self.next_expiry, item['expires_at'])
+        search_cache.invalidate([listing_filter_keys(item)])
+
+    # Returns the filter keys the row had before the update, so the counters can move by delta,
+    # or None without writing anything when another worker or the expiry sweep removed the row
+    def update_listing_sync(self, item, statements):
+        with self.conn:
+            # Take the write lock before reading, so no other worker changes the row in between
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT city, category_id, is_free FROM listings WHERE id = ?", (item['id'],)).fetchone()
+            if row is None:
+                return None
+            old_keys = listing_filter_keys({'city': row[0], 'category_id': row[1], 'is_free': row[2]})
+            for sql, params in [*statements, self.change_statement(item['id'], [old_keys, listing_filter_keys(item)])]:
+                self.conn.execute(sql, params)
+        return old_keys
+
+    async def update_listing(self, item):
+        item['version'] = item.get('version', 0) + 1
+        old_keys = await run_persistence(self.update_listing_sync, item, self.listing_statements(item))
+        if old_keys is None:
+            return False
+        self.counters.add(old_keys, -1)
+        self.counters.add(listing_filter_keys(item))
+        self.next_expiry = min(self.next_expiry, item['expires_at'])
+        search_cache.invalidate([old_keys, listing_filter_keys(item)])
+        return True
+
+    async def delete_listing(self, listing_id):
+        item = await self.get_listing(listing_id)
+        if item is not None:
+            await self.execute(
+                ("DELETE FROM listings WHERE id = ?", (listing_id,)),
+                ("DELETE FROM listing_terms WHERE listing_id = ?", (listing_id,)),
+                self.change_statement(listing_id, [listing_filter_keys(item)])
+            )
+            self.counters.add(listing_filter_keys(item), -1)
+            search_cache.invalidate([listing_filter_keys(item)])
+            card_cache.discard(listing_id)
+        return item
+
+    def next_listing_id_sync(self):
+        with self.conn:
+            return self.conn.execute("UPDATE sequences SET value = value + 1 WHERE name = 'listings' RETURNING value").fetchone()[0]
+
+    async def generate_listing_id(self):
+        return str(await run_persistence(self.next_listing_id_sync))
+
+    def read_changes_sync(self, after):
+        return self.conn.execute("SELECT seq, worker, listing_id, filter_keys FROM change_log WHERE seq > ? ORDER BY seq", (after,)).fetchall()
+
+    # Replays other workers' changes onto this worker's caches; the counters are reloaded whole,
+    # which also corrects any drift from concurrent updates
+    async def sync_changes(self):
+        rows = await run_persistence(self.read_changes_sync, self.change_seq)
+        if not rows:
+            return 0
+        previous_seq, self.change_seq = self.change_seq, rows[-1][0]
+        if previous_seq // 1000 != self.change_seq // 1000:
+            await self.execute(("DELETE FROM change_log WHERE seq <= ?", (self.change_seq - self.change_log_keep,)))
+        foreign = [row for row in rows if row[1] != self.worker_id]
+        if not foreign:
+            return 0
+        keys = []
+        for _, _, listing_id, filter_keys in foreign:
+            card_cache.discard(listing_id)
+            keys.extend(tuple(listing_keys) for listing_keys in json.loads(filter_keys))
+        search_cache.invalidate(keys)
+        self.counters = await run_persistence(self.load_counters_sync)
+        self.next_expiry = datetime.datetime.min
+        return len(foreign)
+
+    async def search_listings(self, keyword, category, city, now):
+        terms = tokenize_search_text(fold_text(keyword)) if keyword else set()
+        conditions = ["expires_at > ?"]
+        params = [format_db_datetime(now)]
+        for term in terms:
+            conditions.append("id IN (SELECT listing_id FROM listing_terms WHERE term = ?)")
+            params.append(term)
+        if category == FREE_CATEGORY_ID:
+            conditions.append("is_free = 1")
+        elif category is not None:
+            conditions.append("category_id = ?")
+            params.append(category)
+        if city:
+            conditions.append("city = ?")
+            params.append(city)
+        # Ages in days are computed by SQLite, so the rows need no datetime parsing here
+        rows = await self.query(
+            f"SELECT id, title_terms, julianday(?) - julianday(posted_at), julianday(expires_at) - julianday(?), is_free, rowid "
+            f"FROM listings WHERE {' AND '.join(conditions)}",
+            [format_db_datetime(now), format_db_datetime(now), *params]
+        )
+        return RankedResults(
+            (listing_score(terms, title_terms.split(), age_days, days_left, is_free), rowid, listing_id)
+            for listing_id, title_terms, age_days, days_left, is_free, rowid in rows
+        )
 
+    async def search_nearby(self, latitude, longitude, radius_km, now):
+        cells = geo_cells_around(latitude, longitude, radius_km)
+        rows = await self.query(
+            f"SELECT id, latitude, longitude FROM listings WHERE geo_cell IN ({','.join('?' * len(cells))}) AND expires_at > ?",
+            (*cells, format_db_datetime(now))
+        )
+        return rank_by_distance(rows, latitude, longitude, radius_km)
+
+    async def active_user_listings(self, user_id, now):
+        rows = await self.query("SELECT data FROM listings WHERE user_id = ? AND expires_at > ? ORDER BY rowid", (user_id, format_db_datetime(now)))
+        return [parse_listing_datetimes(json.loads(row[0])) for row in rows]
+
+    async def count_listings_by_category(self, now):
+        await self.expire_listings(now)
+        counts = {category_id: self.counters.by_category[category_id] for category_id in category_ids}
+        counts[FREE_CATEGORY_ID] = self.counters.free
+        return counts
+
+    # The expires_at index plays the role of the expiry heap: due rows are a range scan
+    def expire_listings_sync(self, now):
+        cutoff = format_db_datetime(now)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            due = self.conn.execute("SELECT id, city, category_id, is_free FROM listings WHERE expires_at <= ?", (cutoff,)).fetchall()
+            if due:
+                self.conn.executemany(
+                    "INSERT INTO change_log (worker, listing_id, filter_keys) VALUES (?, ?, ?)",
+                    [self.change_statement(listing_id, [listing_filter_keys({'city': city, 'category_id': category_id, 'is_free': is_free})])[1] for listing_id, city, category_id, is_free in due]
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO archived_listings (id, user_id, expires_at, archived_at, data) "
+                    "SELECT id, user_id, expires_at, ?, data FROM listings WHERE expires_at <= ?",
+                    (cutoff, cutoff)
+                )
+                self.conn.execute("DELETE FROM listing_terms WHERE listing_id IN (SELECT id FROM listings WHERE expires_at <= ?)", (cutoff,))
+                self.conn.execute("DELETE FROM listings WHERE expires_at <= ?", (cutoff,))
+            next_expiry = self.conn.execute("SELECT MIN(expires_at) FROM listings").fetchone()[0]
+        return due, datetime.datetime.fromisoformat(next_expiry) if next_expiry else datetime.datetime.max
+
+    # Earliest expires_at is tracked in memory, so until then expiry checks (and cached searches) skip SQLite
+    async def expire_listings(self, now):
+        if now < self.next_expiry:
+            return 0
+        due, self.next_expiry = await run_persistence(self.expire_listings_sync, now)
+        due_keys = [listing_filter_keys({'city': city, 'category_id': category_id, 'is_free': is_free}) for _, city, category_id, is_free in due]
+        for listing_id, *_ in due:
+            card_cache.discard(listing_id)
+        for keys in due_keys:
+            self.counters.add(keys, -1)
+        if due:
+            search_cache.invalidate(due_keys)
+            logger.info(f"🗃 Archived {len(due)} expired listings.")
+        return len(due)
+
+    async def count_listings_by_city(self, now):
+        await self.expire_listings(now)
+        return {city: self.counters.by_city[city] for city in city_mapping.values()}
+
+storage = SqliteStorage(SQLITE_PATH) if STORAGE_BACKEND == "sqlite" else JsonStorage()
+
+async def count_listings_by_category():
+    return await storage.count_listings_by_category(datetime.datetime.now())
+
+async def count_listings_by_city():
+    return await storage.count_listings_by_city(datetime.datetime.now())
+
+async def is_banned(user_id):
+    user = await storage.get_user(user_id)
+    return bool(user and user.get('banned', False))
+
+async def run_search(query):
+    await storage.expire_listings(datetime.datetime.now())
+    cached = search_cache.lookup(query)
+    if cached is not None:
+        return cached
+    version = search_cache.version
+    if query[0] == NEARBY_QUERY:
+        results = await storage.search_nearby(query[1], query[2], NEARBY_RADIUS_KM, datetime.datetime.now())
+    else:
+        results = await storage.search_listings(*query[1:], datetime.datetime.now())
+    return search_cache.store(query, results, version)
+
+# The result list of the session's search, re-running the query if its snapshot was evicted
+async def get_search_results(state: FSMContext, data):
+    query = data.get('search_query')
+    # Sessions saved before query keys carried their kind have nothing left to page through
+    if not query or query[0] not in (KEYWORD_QUERY, NEARBY_QUERY):
+        return ()
+    query = tuple(query)
+    results = search_cache.snapshot(data.get('search_token'), query)
+    if results is None:
+        token, results = await run_search(query)
+        await state.update_data(search_token=token)
+    return results
+
+# Caption, photo ids and album for a listing; the keyboard depends on the viewer's position and is built per call
+def render_item_card(item, mode):
     item_title = escape(item['title'])
     item_category = escape(item['category'])
     item_price = escape(str(item['price']))
@@ -333,9 +2330,9 @@ async def display_item_card(chat_id, listing_id, message_id=None, caller_is_sear
 
     title_prefix = "♾ ¡Gratis!" if item.get('is_free', False) else ""
     notification = ""
-    if not caller_is_search and not caller_is_edit:
+    if mode == "created":
         notification = f"<b>✅ Anuncio #{item['id']} publicado exitosamente!</b>\n"
-    elif caller_is_edit:
+    elif mode == "edit":
         notification = f"<b>✅ Anuncio #{item['id']} editado exitosamente!</b>\n"
 
     caption_text = (
@@ -360,10 +2357,43 @@ async def display_item_card(chat_id, listing_id, message_id=None, caller_is_sear
         else:
             media_group.append(InputMediaPhoto(media=photo_id))
 
-    reply_markup = get_item_card_keyboard(caller_is_search, caller_is_edit, current_index, total_results, listing_id)
+    return caption_text, photos, media_group
+
+def get_item_card(item, mode):
+    card = card_cache.get(item['id'], item.get('version', 0), mode)
+    if card is None:
+        card = render_item_card(item, mode)
+        card_cache.put(item['id'], item.get('version', 0), mode, card)
+    return card
+
+# With message_id, a search card is edited into that message when possible; returns True if it was,
+# so the caller knows not to delete the old message.
+async def display_item_card(chat_id, listing_id, message_id=None, caller_is_search=False, caller_is_edit=False, current_index=0, total_results=0):
+    item = await storage.get_listing(listing_id)
+    if not item:
+        logger.warning(f"⚠️ Attempt to display nonexistent listing ID: {listing_id}")
+        return
+
+    mode = "search" if caller_is_search else "edit" if caller_is_edit else "created"
+    caption_text, photos, media_group = get_item_card(item, mode)
+
+    reply_markup = get_item_card_keyboard(caller_is_search, caller_is_edit, current_index, total_results, listing_id, len(photos))
 
     try:
-        if media_group:
+        if caller_is_search and media_group:
+            # Search results are a carousel: one photo message that browsing edits in place;
+            # the full album is sent only from its "all photos" button
+            if message_id is not None:
+                try:
+                    await bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=media_group[0], reply_markup=reply_markup)
+                    return True
+                except TelegramBadRequest as e:
+                    logger.debug("🖼 Could not edit card %s in place, sending a new one: %s", message_id, e)
+            await bot.send_photo(chat_id=chat_id, photo=photos[0], caption=caption_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        elif len(photos) == 1:
+            # A single photo carries the caption and the keyboard in one message
+            await bot.send_photo(chat_id=chat_id, photo=photos[0], caption=caption_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        elif media_group:
             sent_messages = await bot.send_media_group(chat_id=chat_id, media=media_group)
             if reply_markup:
                 await bot.send_message(chat_id=chat_id, text="⬆️⬆️ Anuncio completo arriba ⬆️⬆️", reply_markup=reply_markup)
@@ -375,7 +2405,7 @@ async def display_item_card(chat_id, listing_id, message_id=None, caller_is_sear
 
 async def display_search_results(message: Message, state: FSMContext):
     data = await state.get_data()
-    results = data.get('search_results', [])
+    results = await get_search_results(state, data)
     user_id = message.from_user.id
 
     if not results:
@@ -384,8 +2414,11 @@ async def display_search_results(message: Message, state: FSMContext):
         return
 
     keyboard_buttons = []
+    page_items = await storage.get_listings(results[:5])
     for idx, listing_id in enumerate(results[:5]):
-        item = listings[listing_id]
+        item = page_items.get(listing_id)
+        if item is None:
+            continue
         button_text = f"#{item['id']} {'♾ ¡Gratis!' if item.get('is_free', False) else ''} {item['title']} ({item['price']})"
         keyboard_buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"view_search_item_{listing_id}_{idx}")])
     if len(results) > 5:
@@ -395,6 +2428,24 @@ async def display_search_results(message: Message, state: FSMContext):
     reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     await message.reply(f"🛒 Anuncios encontrados: {len(results)}. Seleccione para ver:", reply_markup=reply_markup)
 
+async def get_selected_listing(message: Message, state: FSMContext):
+    data = await state.get_data()
+    item = await storage.get_listing(data.get('selected_item_id'))
+    if item is None:
+        await message.answer("❗ Error: anuncio no encontrado.", reply_markup=main_keyboard)
+        await state.clear()
+        return None
+    # Edits go to a copy: the stored record may be in a snapshot the writer thread is serializing
+    return dict(item)
+
+# The listing may have been deleted or archived while the user was typing the new value
+async def save_edited_listing(message: Message, state: FSMContext, item):
+    if await storage.update_listing(item):
+        return True
+    await message.answer("❗ Error: anuncio no encontrado.", reply_markup=main_keyboard)
+    await state.clear()
+    return False
+
 # 🤖 Handlers
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
@@ -402,10 +2453,10 @@ async def cmd_start(message: Message, state: FSMContext):
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={user_id}")
         return
-    if user_id not in user_data:
-        user_data[user_id] = {"listings": [], "favorites": [], "banned": False}
-        await save_user_data()
-    if user_data.get(user_id, {}).get('banned', False):
+    user = await storage.get_user(user_id)
+    if user is None:
+        user = await storage.create_user(user_id)
+    if user.get('banned', False):
         await message.answer("🚫 Su cuenta está bloqueada. Contacte al administrador.")
         return
     await message.answer(
@@ -428,12 +2479,12 @@ async def add_item_start(message: Message, state: FSMContext):
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={user_id}")
         return
-    if user_data.get(user_id, {}).get('banned', False):
+    if await is_banned(user_id):
         await message.answer("🚫 Su cuenta está bloqueada.")
         return
     await message.answer(
         "📋 Seleccione la categoría para el objeto o '📦 ¡Kit de mudanza!' para un conjunto de objetos:",
-        reply_markup=get_categories_keyboard()
+        reply_markup=await get_categories_keyboard()
     )
     await state.set_state(ItemForm.item_category)
 
@@ -443,7 +2494,7 @@ async def process_category(message: Message, state: FSMContext):
     if category not in categories:
         await message.answer(
             "❗ Por favor, seleccione una categoría de las propuestas:",
-            reply_markup=get_categories_keyboard()
+            reply_markup=await get_categories_keyboard()
         )
         return
     await state.update_data(item_category=category)
@@ -537,10 +2588,10 @@ async def process_additional_photos(message: Message, state: FSMContext):
 @dp.message(ItemForm.item_price_value)
 async def process_price_value(message: Message, state: FSMContext):
     price_text = message.text.strip().lower()
-    logger.debug(f"💰 Processing price input: '{price_text}'")
+    trace_logger.debug("💰 Processing price input: '%s'", price_text)
     if price_text == "gratis":
         await state.update_data(item_price="Gratis", item_status="free", is_free=True)
-        await message.answer("🏙️ Indique la ciudad:", reply_markup=get_cities_keyboard())
+        await message.answer("🏙️ Indique la ciudad:", reply_markup=await get_cities_keyboard())
         await state.set_state(ItemForm.item_city)
         return
     try:
@@ -551,7 +2602,7 @@ async def process_price_value(message: Message, state: FSMContext):
             await state.update_data(item_price="Gratis", item_status="free", is_free=True)
         else:
             await state.update_data(item_price=f"{price:.2f}", item_status="sell", is_free=False)
-        await message.answer("🏙️ Indique la ciudad:", reply_markup=get_cities_keyboard())
+        await message.answer("🏙️ Indique la ciudad:", reply_markup=await get_cities_keyboard())
         await state.set_state(ItemForm.item_city)
     except ValueError:
         await message.answer(
@@ -565,7 +2616,7 @@ async def process_city(message: Message, state: FSMContext):
     if city not in cities:
         await message.answer(
             "❗ Por favor, seleccione una ciudad de las propuestas:",
-            reply_markup=get_cities_keyboard()
+            reply_markup=await get_cities_keyboard()
         )
         return
     await state.update_data(item_city=city_mapping[city])
@@ -582,7 +2633,7 @@ async def process_item_city_callback(callback: CallbackQuery, state: FSMContext)
         await callback.answer()
         return
     city = callback.data.replace("search_city_", "")
-    logger.debug(f"📍 Item city selected: '{city}'")
+    trace_logger.debug("📍 Item city selected: '%s'", city)
     if city not in cities:
         await callback.message.answer(
             "❗ Error: ciudad no encontrada.",
@@ -671,9 +2722,10 @@ async def process_expires_at(message: Message, state: FSMContext):
     expires_at = datetime.datetime.now() + datetime.timedelta(days=days)
 
     item = {
-        'id': generate_listing_id(),
+        'id': await storage.generate_listing_id(),
         'user_id': user_id,
         'category': data.get('item_category'),
+        'category_id': category_ids_by_label.get(data.get('item_category')),
         'title': data.get('item_title'),
         'description': data.get('item_description', ""),
         'photo_id': data.get('item_photo_id'),
@@ -688,15 +2740,11 @@ async def process_expires_at(message: Message, state: FSMContext):
         'contact': data.get('item_contact'),
         'posted_at': datetime.datetime.now(),
         'expires_at': expires_at,
-        'views': 0
+        'views': 0,
+        'version': 0
     }
 
-    listings[item['id']] = item
-    if user_id not in user_data:
-        user_data[user_id] = {"listings": [], "favorites": [], "banned": False}
-    user_data[user_id]['listings'].append(item['id'])
-    await save_listings()
-    await save_user_data()
+    await storage.create_listing(item)
 
     logger.info(f"✅ User {user_id} added item: {item['title']}")
     await display_item_card(user_id, item['id'])
@@ -709,8 +2757,8 @@ async def search_item_start(message: Message, state: FSMContext):
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={user_id}")
         return
-    logger.debug(f"🔍 Search started by user {user_id}: text='{message.text}'")
-    if user_data.get(user_id, {}).get('banned', False):
+    trace_logger.debug("🔍 Search started by user %s: text='%s'", user_id, message.text)
+    if await is_banned(user_id):
         await message.answer("🚫 Estás bloqueado.")
         return
     await message.answer(
@@ -727,7 +2775,7 @@ async def skip_keyword(message: Message, state: FSMContext):
     await state.update_data(keyword="")
     await message.answer(
         "📋 Seleccione una categoría para la búsqueda o omita:",
-        reply_markup=get_categories_keyboard(is_search=True)
+        reply_markup=await get_categories_keyboard(is_search=True)
     )
     await state.set_state(SearchForm.category)
 
@@ -737,11 +2785,11 @@ async def process_keyword(message: Message, state: FSMContext):
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
     keyword = message.text.strip()
-    logger.debug(f"🔎 Search keyword: '{keyword}'")
+    trace_logger.debug("🔎 Search keyword: '%s'", keyword)
     await state.update_data(keyword=keyword)
     await message.answer(
         "📋 Seleccione una categoría para la búsqueda o omita:",
-        reply_markup=get_categories_keyboard(is_search=True)
+        reply_markup=await get_categories_keyboard(is_search=True)
     )
     await state.set_state(SearchForm.category)
 
@@ -751,10 +2799,10 @@ async def process_search_category_callback(callback: CallbackQuery, state: FSMCo
         logger.warning(f"⚠️ Ignoring callback from bot: user_id={callback.from_user.id}")
         await callback.answer()
         return
-    category = callback.data.replace("search_category_", "")
-    logger.debug(f"📋 Search category selected: '{category}'")
-    valid_categories = [c.replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', '') for c in categories] + ['Gratis']
-    if category not in valid_categories:
+    slug = callback.data.replace("search_category_", "")
+    trace_logger.debug("📋 Search category selected: '%s'", slug)
+    category = category_ids_by_slug.get(slug)
+    if category is None:
         await callback.message.answer(
             "❗ Error: categoría no encontrada.",
             reply_markup=main_keyboard
@@ -765,7 +2813,7 @@ async def process_search_category_callback(callback: CallbackQuery, state: FSMCo
     await state.update_data(category=category)
     await callback.message.answer(
         "🏙️ Seleccione una ciudad para la búsqueda o omita:",
-        reply_markup=get_cities_keyboard()
+        reply_markup=await get_cities_keyboard()
     )
     await state.set_state(SearchForm.city)
     await callback.message.delete()
@@ -777,10 +2825,10 @@ async def skip_category_callback(callback: CallbackQuery, state: FSMContext):
         logger.warning(f"⚠️ Ignoring callback from bot: user_id={callback.from_user.id}")
         await callback.answer()
         return
-    await state.update_data(category="")
+    await state.update_data(category=None)
     await callback.message.answer(
         "🏙️ Seleccione una ciudad para la búsqueda o omitа:",
-        reply_markup=get_cities_keyboard()
+        reply_markup=await get_cities_keyboard()
     )
     await state.set_state(SearchForm.city)
     await callback.message.delete()
@@ -793,7 +2841,7 @@ async def process_search_city_callback(callback: CallbackQuery, state: FSMContex
         await callback.answer()
         return
     city = callback.data.replace("search_city_", "")
-    logger.debug(f"📍 Search city selected: '{city}'")
+    trace_logger.debug("📍 Search city selected: '%s'", city)
     if city not in cities:
         await callback.message.answer(
             "❗ Error: ciudad no encontrada.",
@@ -821,61 +2869,72 @@ async def skip_city_callback(callback: CallbackQuery, state: FSMContext):
 async def perform_search(message: Message, state: FSMContext, chat_id: int):
     data = await state.get_data()
     keyword = data.get('keyword', "").lower()
-    category = data.get('category', "")
+    category = data.get('category')
     city = data.get('city', "")
 
-    logger.debug(f"🔍 Performing search: keyword='{keyword}', category='{category}', city='{city}'")
-
-    results = []
-    for listing_id, item in listings.items():
-        if item['expires_at'] > datetime.datetime.now():
-            logger.debug(f"🔎 Checking listing #{listing_id}: title='{item['title']}', description='{item.get('description', '')}'")
-            title_match = not keyword or keyword in item['title'].lower() or keyword in item.get('description', '').lower()
-            category_match = (
-                not category or
-                (category == 'Gratis' and item.get('is_free', False)) or
-                item['category'].replace('📦 ', '').replace('🛋️ ', '').replace('📱 ', '').replace('👗 ', '').replace('👜 ', '').replace('📚 ', '').replace('🧸 ', '').replace('🔌 ', '').replace('🏀 ', '').replace('🌟 ', '') == category
-            )
-            city_match = not city or item['city'] == city
-            if title_match and category_match and city_match:
-                logger.debug(f"✅ Listing #{listing_id} matches search criteria")
-                results.append(listing_id)
-            else:
-                logger.debug(f"❌ Listing #{listing_id} does not match: title_match={title_match}, category_match={category_match}, city_match={city_match}")
+    trace_logger.debug("🔍 Performing search: keyword='%s', category='%s', city='%s'", keyword, category, city)
 
-    results.sort(key=lambda x: not listings[x].get('is_free', False))
+    query = search_query_key(keyword, category, city)
+    token, results = await run_search(query)
 
-    logger.debug(f"🛒 Search results: {len(results)} items found")
+    trace_logger.debug("🛒 Search results: %d items found", len(results))
 
     if not results:
         await message.answer("🔍 No se encontraron resultados. Intente modificar la búsqueda.", reply_markup=main_keyboard)
         await state.clear()
         return
 
-    await state.update_data(search_results=results, current_result_index=0)
+    await state.update_data(search_query=list(query), search_token=token, current_result_index=0)
     await display_item_card(chat_id, results[0], caller_is_search=True, current_index=0, total_results=len(results))
 
+@dp.message(F.text == "📍 Cerca de mí")
+async def nearby_search_start(message: Message, state: FSMContext):
+    user_id = message.from_user.id
+    if message.from_user.is_bot:
+        logger.warning(f"⚠️ Ignoring command from bot: user_id={user_id}")
+        return
+    if await is_banned(user_id):
+        await message.answer("🚫 Estás bloqueado.")
+        return
+    await state.clear()
+    await message.answer(
+        f"📍 Envíe su ubicación para ver los anuncios a menos de {NEARBY_RADIUS_KM:g} km:",
+        reply_markup=nearby_location_keyboard
+    )
+    await state.set_state(SearchForm.nearby_location)
+
+@dp.message(SearchForm.nearby_location, F.location)
+async def process_nearby_location(message: Message, state: FSMContext):
+    query = nearby_query_key(message.location.latitude, message.location.longitude)
+    trace_logger.debug("📍 Nearby search by user %s around %s, %s", message.from_user.id, query[1], query[2])
+    token, results = await run_search(query)
+    if not results:
+        await message.answer(f"📍 No hay anuncios a menos de {NEARBY_RADIUS_KM:g} km.", reply_markup=main_keyboard)
+        await state.clear()
+        return
+    await state.update_data(search_query=list(query), search_token=token, current_result_index=0)
+    # Leave nearby_location but keep the data: the result buttons read the query from it
+    await state.set_state(None)
+    await message.answer(f"📍 Anuncios encontrados cerca de usted: {len(results)}, del más cercano al más lejano.", reply_markup=main_keyboard)
+    await display_item_card(message.chat.id, results[0], caller_is_search=True, current_index=0, total_results=len(results))
+
 @dp.message(F.text == "📋 Mis anuncios")
 async def show_my_listings(message: Message, state: FSMContext):
     user_id = message.from_user.id
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={user_id}")
         return
-    if user_data.get(user_id, {}).get('banned', False):
+    if await is_banned(user_id):
         await message.answer("🚫 Su cuenta está bloqueada.")
         return
-    if user_id not in user_data or not user_data[user_id].get('listings'):
-        await message.answer("📭 No tienes anuncios activos.", reply_markup=main_keyboard)
-        return
-
-    active_listings = [lid for lid in user_data[user_id]['listings'] if listings.get(lid) and listings[lid]['expires_at'] > datetime.datetime.now()]
+    active_listings = await storage.active_user_listings(user_id, datetime.datetime.now())
     if not active_listings:
         await message.answer("📭 No tienes anuncios activos.", reply_markup=main_keyboard)
         return
 
     keyboard_buttons = []
-    for listing_id in active_listings:
-        item = listings[listing_id]
+    for item in active_listings:
+        listing_id = item['id']
         button_text = f"🛒 #{item['id']} {'♾ ¡Gratis!' if item.get('is_free', False) else ''} {item['title']} (${item['price']})"
         keyboard_buttons.append([
             InlineKeyboardButton(text=button_text, callback_data=f"view_item_{listing_id}"),
@@ -907,9 +2966,9 @@ async def view_search_item_callback(callback: CallbackQuery, state: FSMContext):
     listing_id = parts[3]
     index = int(parts[4])
     data = await state.get_data()
-    results = data.get('search_results', [])
+    results = await get_search_results(state, data)
 
-    if listing_id not in listings or listing_id not in results:
+    if index >= len(results) or results[index] != listing_id or await storage.get_listing(listing_id) is None:
         await callback.message.answer("❗ Anuncio no encontrado.", reply_markup=main_keyboard)
         await state.clear()
         await callback.message.delete()
@@ -928,7 +2987,7 @@ async def search_prev_callback(callback: CallbackQuery, state: FSMContext):
         return
     current_index = int(callback.data.replace("search_prev_", ""))
     data = await state.get_data()
-    results = data.get('search_results', [])
+    results = await get_search_results(state, data)
 
     if current_index <= 0 or not results:
         await callback.answer("⛔ Este es el primer anuncio.")
@@ -936,8 +2995,9 @@ async def search_prev_callback(callback: CallbackQuery, state: FSMContext):
 
     new_index = current_index - 1
     await state.update_data(current_result_index=new_index)
-    await display_item_card(callback.message.chat.id, results[new_index], caller_is_search=True, current_index=new_index, total_results=len(results))
-    await callback.message.delete()
+    edited = await display_item_card(callback.message.chat.id, results[new_index], message_id=callback.message.message_id, caller_is_search=True, current_index=new_index, total_results=len(results))
+    if not edited:
+        await callback.message.delete()
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("search_next_"))
@@ -948,7 +3008,7 @@ async def search_next_callback(callback: CallbackQuery, state: FSMContext):
         return
     current_index = int(callback.data.replace("search_next_", ""))
     data = await state.get_data()
-    results = data.get('search_results', [])
+    results = await get_search_results(state, data)
 
     if current_index >= len(results) - 1 or not results:
         await callback.answer("⛔ Este es el último anuncio.")
@@ -956,8 +3016,26 @@ async def search_next_callback(callback: CallbackQuery, state: FSMContext):
 
     new_index = current_index + 1
     await state.update_data(current_result_index=new_index)
-    await display_item_card(callback.message.chat.id, results[new_index], caller_is_search=True, current_index=new_index, total_results=len(results))
-    await callback.message.delete()
+    edited = await display_item_card(callback.message.chat.id, results[new_index], message_id=callback.message.message_id, caller_is_search=True, current_index=new_index, total_results=len(results))
+    if not edited:
+        await callback.message.delete()
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("search_photos_"))
+async def search_photos_callback(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.is_bot:
+        logger.warning(f"⚠️ Ignoring callback from bot: user_id={callback.from_user.id}")
+        await callback.answer()
+        return
+    item = await storage.get_listing(callback.data.replace("search_photos_", ""))
+    if item is None:
+        await callback.answer("❗ Anuncio no encontrado.")
+        return
+    _, _, media_group = get_item_card(item, "search")
+    try:
+        await bot.send_media_group(chat_id=callback.message.chat.id, media=media_group)
+    except TelegramBadRequest as e:
+        logger.error(f"❌ Failed to send photos of item {item['id']}: {e}")
     await callback.answer()
 
 @dp.callback_query(F.data == "show_more_results")
@@ -967,7 +3045,7 @@ async def show_more_results(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
     data = await state.get_data()
-    results = data.get('search_results', [])
+    results = await get_search_results(state, data)
     current_page = data.get('search_page', 0)
 
     next_page = current_page + 1
@@ -977,8 +3055,11 @@ async def show_more_results(callback: CallbackQuery, state: FSMContext):
         return
 
     keyboard_buttons = []
+    page_items = await storage.get_listings(results[start_idx:start_idx+5])
     for idx, listing_id in enumerate(results[start_idx:start_idx+5]):
-        item = listings[listing_id]
+        item = page_items.get(listing_id)
+        if item is None:
+            continue
         button_text = f"🛒 #{item['id']} {'♾ ¡Gratis!' if item.get('is_free', False) else ''} {item['title']} (${item['price']})"
         keyboard_buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"view_search_item_{listing_id}_{start_idx+idx}")])
     if start_idx + 5 < len(results):
@@ -999,7 +3080,7 @@ async def show_prev_results(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
     data = await state.get_data()
-    results = data.get('search_results', [])
+    results = await get_search_results(state, data)
     current_page = data.get('search_page', 0)
 
     prev_page = current_page - 1
@@ -1009,8 +3090,11 @@ async def show_prev_results(callback: CallbackQuery, state: FSMContext):
 
     start_idx = prev_page * 5
     keyboard_buttons = []
+    page_items = await storage.get_listings(results[start_idx:start_idx+5])
     for idx, listing_id in enumerate(results[start_idx:start_idx+5]):
-        item = listings[listing_id]
+        item = page_items.get(listing_id)
+        if item is None:
+            continue
         button_text = f"🛒 #{item['id']} {'♾ ¡Gratis!' if item.get('is_free', False) else ''} {item['title']} (${item['price']})"
         keyboard_buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"view_search_item_{listing_id}_{start_idx+idx}")])
     if start_idx + 5 < len(results):
@@ -1042,7 +3126,8 @@ async def view_item_callback(callback: CallbackQuery, state: FSMContext):
         return
     listing_id = callback.data.replace("view_item_", "")
     user_id = callback.from_user.id
-    if listing_id not in listings or listings[listing_id]['user_id'] != user_id:
+    item = await storage.get_listing(listing_id)
+    if item is None or item['user_id'] != user_id:
         await callback.message.answer("❗ Anuncio no encontrado o no le pertenece.", reply_markup=main_keyboard)
         await state.clear()
         await callback.message.delete()
@@ -1060,7 +3145,8 @@ async def edit_item_callback(callback: CallbackQuery, state: FSMContext):
         return
     listing_id = callback.data.replace("edit_item_", "")
     user_id = callback.from_user.id
-    if listing_id not in listings or listings[listing_id]['user_id'] != user_id:
+    item = await storage.get_listing(listing_id)
+    if item is None or item['user_id'] != user_id:
         await callback.message.answer("❗ Anuncio no encontrado o no le pertenece.", reply_markup=main_keyboard)
         await state.clear()
         return
@@ -1081,14 +3167,14 @@ async def delete_item_callback(callback: CallbackQuery, state: FSMContext):
         return
     listing_id = callback.data.replace("delete_item_", "")
     user_id = callback.from_user.id
-    if listing_id not in listings or listings[listing_id]['user_id'] != user_id:
+    item = await storage.get_listing(listing_id)
+    if item is None or item['user_id'] != user_id:
         await callback.message.answer("❗ Anuncio no encontrado o no le pertenece.", reply_markup=main_keyboard)
         await state.clear()
         await callback.message.delete()
         return
 
     await state.update_data(selected_item_id=listing_id)
-    item = listings[listing_id]
     await callback.message.answer(
         f"⚠️ ¿Está seguro de que desea eliminar el anuncio #{item['id']} {'♾ ¡Gratis!' if item.get('is_free', False) else ''} {item['title']}?",
         reply_markup=get_confirm_delete_keyboard(listing_id)
@@ -1103,16 +3189,14 @@ async def confirm_delete_callback(callback: CallbackQuery, state: FSMContext):
         return
     listing_id = callback.data.replace("confirm_delete_", "")
     user_id = callback.from_user.id
-    if listing_id not in listings or listings[listing_id]['user_id'] != user_id:
+    item = await storage.get_listing(listing_id)
+    if item is None or item['user_id'] != user_id:
         await callback.message.answer("❗ Anuncio no encontrado o no le pertenece.", reply_markup=main_keyboard)
         await state.clear()
         await callback.message.delete()
         return
 
-    item = listings.pop(listing_id)
-    user_data[user_id]['listings'].remove(listing_id)
-    await save_listings()
-    await save_user_data()
+    await storage.delete_listing(listing_id)
 
     logger.info(f"✅ User {user_id} deleted item {listing_id}: {item['title']}")
     await callback.message.answer(f"🗑 Anuncio #{item['id']} eliminado exitosamente.", reply_markup=main_keyboard)
@@ -1138,7 +3222,8 @@ async def process_choose_field(message: Message, state: FSMContext):
 
     data = await state.get_data()
     listing_id = data.get('selected_item_id')
-    if not listing_id or listing_id not in listings:
+    item = await storage.get_listing(listing_id) if listing_id else None
+    if item is None:
         await message.answer("❗ Error: anuncio no encontrado.", reply_markup=main_keyboard)
         await state.clear()
         return
@@ -1146,7 +3231,7 @@ async def process_choose_field(message: Message, state: FSMContext):
     if field == "📋 Categoría":
         await message.answer(
             "📋 Seleccione una nueva categoría:",
-            reply_markup=get_categories_keyboard()
+            reply_markup=await get_categories_keyboard()
         )
         await state.set_state(EditForm.edit_category)
     elif field == "✏️ Título":
@@ -1168,8 +3253,7 @@ async def process_choose_field(message: Message, state: FSMContext):
         )
         await state.set_state(EditForm.edit_photo)
     elif field == "📷 Fotos adicionales":
-        data = await state.get_data()
-        max_photos = 9 if listings[listing_id]['category'] == "📦 ¡Kit de mudanza!" else 3
+        max_photos = 9 if item['category'] == "📦 ¡Kit de mudanza!" else 3
         await message.answer(
             f"📷 Envíe hasta {max_photos} nuevas fotos adicionales o omitа:",
             reply_markup=get_skip_keyboard()
@@ -1184,7 +3268,7 @@ async def process_choose_field(message: Message, state: FSMContext):
     elif field == "🏙️ Ciudad":
         await message.answer(
             "🏙️ Seleccione una nueva ciudad:",
-            reply_markup=get_cities_keyboard()
+            reply_markup=await get_cities_keyboard()
         )
         await state.set_state(EditForm.edit_city)
     elif field == "📍 Geolocalización":
@@ -1215,14 +3299,18 @@ async def process_edit_category(message: Message, state: FSMContext):
     if category not in categories:
         await message.answer(
             "❗ Por favor, seleccione una categoría de las propuestas:",
-            reply_markup=get_categories_keyboard()
+            reply_markup=await get_categories_keyboard()
         )
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['category'] = category
-    await save_listings()
+    item['category'] = category
+    item['category_id'] = category_ids_by_label[category]
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited category of item {listing_id} to '{category}'")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1240,11 +3328,14 @@ async def process_edit_title(message: Message, state: FSMContext):
             reply_markup=cancel_keyboard
         )
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['title'] = title
-    await save_listings()
+    item['title'] = title
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited title of item {listing_id} to '{title}'")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1255,11 +3346,14 @@ async def skip_edit_description(message: Message, state: FSMContext):
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['description'] = ""
-    await save_listings()
+    item['description'] = ""
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} cleared description of item {listing_id}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1277,11 +3371,14 @@ async def process_edit_description(message: Message, state: FSMContext):
             reply_markup=get_skip_keyboard()
         )
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['description'] = description
-    await save_listings()
+    item['description'] = description
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited description of item {listing_id}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1293,11 +3390,14 @@ async def process_edit_photo(message: Message, state: FSMContext):
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
     photo_id = message.photo[-1].file_id
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['photo_id'] = photo_id
-    await save_listings()
+    item['photo_id'] = photo_id
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited photo of item {listing_id}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1308,11 +3408,14 @@ async def skip_edit_additional_photos(message: Message, state: FSMContext):
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['additional_photo_ids'] = []
-    await save_listings()
+    item['additional_photo_ids'] = []
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} cleared additional photos of item {listing_id}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1323,9 +3426,11 @@ async def process_edit_additional_photos(message: Message, state: FSMContext):
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
     data = await state.get_data()
-    listing_id = data.get('selected_item_id')
-    max_photos = 9 if listings[listing_id]['category'] == "📦 ¡Kit de mudanza!" else 3
+    max_photos = 9 if item['category'] == "📦 ¡Kit de mudanza!" else 3
     additional_photos = data.get('edit_additional_photo_ids', [])
 
     if len(additional_photos) >= max_photos:
@@ -1348,14 +3453,17 @@ async def process_edit_price_value(message: Message, state: FSMContext):
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
     price_text = message.text.strip().lower()
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
     if price_text == "gratis":
-        listings[listing_id]['price'] = "Gratis"
-        listings[listing_id]['status'] = "free"
-        listings[listing_id]['is_free'] = True
-        await save_listings()
+        item['price'] = "Gratis"
+        item['status'] = "free"
+        item['is_free'] = True
+        if not await save_edited_listing(message, state, item):
+            return
         logger.info(f"✅ User {message.from_user.id} edited price of item {listing_id} to 'Gratis'")
         await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
         await state.clear()
@@ -1366,15 +3474,16 @@ async def process_edit_price_value(message: Message, state: FSMContext):
         if price < 0:
             raise ValueError
         if price == 0:
-            listings[listing_id]['price'] = "Gratis"
-            listings[listing_id]['status'] = "free"
-            listings[listing_id]['is_free'] = True
+            item['price'] = "Gratis"
+            item['status'] = "free"
+            item['is_free'] = True
         else:
-            listings[listing_id]['price'] = f"{price:.2f}"
-            listings[listing_id]['status'] = "sell"
-            listings[listing_id]['is_free'] = False
-        await save_listings()
-        logger.info(f"✅ User {message.from_user.id} edited price of item {listing_id} to '{listings[listing_id]['price']}'")
+            item['price'] = f"{price:.2f}"
+            item['status'] = "sell"
+            item['is_free'] = False
+        if not await save_edited_listing(message, state, item):
+            return
+        logger.info(f"✅ User {message.from_user.id} edited price of item {listing_id} to '{item['price']}'")
         await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
         await state.clear()
     except ValueError:
@@ -1388,7 +3497,7 @@ async def process_edit_location_city_only(message: Message, state: FSMContext):
     await state.update_data(edit_location_type="city")
     await message.answer(
         "🏙️ Seleccione una nueva ciudad:",
-        reply_markup=get_cities_keyboard()
+        reply_markup=await get_cities_keyboard()
     )
     await state.set_state(EditForm.edit_city)
 
@@ -1397,13 +3506,16 @@ async def process_edit_location_geolocation(message: Message, state: FSMContext)
     if message.from_user.is_bot:
         logger.warning(f"⚠️ Ignoring command from bot: user_id={message.from_user.id}")
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['location_type'] = "geolocation"
-    listings[listing_id]['latitude'] = message.location.latitude
-    listings[listing_id]['longitude'] = message.location.longitude
-    await save_listings()
+    item['location_type'] = "geolocation"
+    item['latitude'] = message.location.latitude
+    item['longitude'] = message.location.longitude
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited geolocation of item {listing_id}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1418,17 +3530,20 @@ async def process_edit_city(message: Message, state: FSMContext):
     if city not in cities:
         await message.answer(
             "❗ Por favor, seleccione una ciudad de las propuestas:",
-            reply_markup=get_cities_keyboard()
+            reply_markup=await get_cities_keyboard()
         )
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['city'] = city_mapping[city]
-    listings[listing_id]['location_type'] = "city"
-    listings[listing_id]['latitude'] = None
-    listings[listing_id]['longitude'] = None
-    await save_listings()
+    item['city'] = city_mapping[city]
+    item['location_type'] = "city"
+    item['latitude'] = None
+    item['longitude'] = None
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited city of item {listing_id} to '{city_mapping[city]}'")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1446,11 +3561,14 @@ async def process_edit_contact(message: Message, state: FSMContext):
             reply_markup=cancel_keyboard
         )
         return
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
 
-    listings[listing_id]['contact'] = contact
-    await save_listings()
+    item['contact'] = contact
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited contact of item {listing_id}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
@@ -1472,17 +3590,25 @@ async def process_edit_expires_at(message: Message, state: FSMContext):
         )
         return
 
-    data = await state.get_data()
-    listing_id = data.get('selected_item_id')
+    item = await get_selected_listing(message, state)
+    if item is None:
+        return
+    listing_id = item['id']
     expires_at = datetime.datetime.now() + datetime.timedelta(days=days)
 
-    listings[listing_id]['expires_at'] = expires_at
-    await save_listings()
+    item['expires_at'] = expires_at
+    if not await save_edited_listing(message, state, item):
+        return
 
     logger.info(f"✅ User {message.from_user.id} edited expiration of item {listing_id} to {expires_at}")
     await display_item_card(message.from_user.id, listing_id, caller_is_edit=True)
     await state.clear()
 
+# Registered after the main-menu handlers, so their buttons still work while a location is awaited
+@dp.message(SearchForm.nearby_location)
+async def process_nearby_location_invalid(message: Message, state: FSMContext):
+    await message.answer("❗ Use el botón para enviar su ubicación.", reply_markup=nearby_location_keyboard)
+
 @dp.message()
 async def handle_unprocessed(message: Message, state: FSMContext):
     if message.from_user.is_bot:
@@ -1491,10 +3617,225 @@ async def handle_unprocessed(message: Message, state: FSMContext):
     logger.warning(f"⚠️ Unprocessed message from user {message.from_user.id}")
     await message.answer("❗ Comando no reconocido. Use el menú principal.", reply_markup=main_keyboard)
 
+async def expiry_worker():
+    while True:
+        await asyncio.sleep(EXPIRY_CHECK_INTERVAL)
+        try:
+            await storage.expire_listings(datetime.datetime.now())
+        except Exception as e:
+            logger.error(f"❌ Failed to expire listings: {e}")
+        if isinstance(fsm_storage, SqliteFsmStorage):
+            try:
+                await fsm_storage.evict_idle()
+            except Exception as e:
+                logger.error(f"❌ Failed to evict idle FSM states: {e}")
+
+# 📈 Metrics endpoint and summary log
+def render_histograms(lines, name, description, histograms, label):
+    lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (math.inf,), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{"+Inf" if bound == math.inf else bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {histogram.sum:.6f}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+
+# `counter` is keyed by a value per label, or by a tuple of values when there are several labels
+def render_counter(lines, name, description, counter, labels, kind="counter"):
+    lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+    for key, value in sorted(counter.items()):
+        label_values = ",".join(f'{label}="{label_value}"' for label, label_value in zip(labels, key if isinstance(key, tuple) else (key,)))
+        lines.append(f"{name}{{{label_values}}} {value}")
+
+def render_metrics():
+    active_listings = len(listings) if STORAGE_BACKEND == "json" else sum(storage.counters.by_city.values())
+    lines = [
+        "# HELP bot_start_time_seconds Unix time the process started.", "# TYPE bot_start_time_seconds gauge",
+        f"bot_start_time_seconds {metrics.started:.0f}",
+        "# HELP bot_updates_total Updates received, handled or not.", "# TYPE bot_updates_total counter",
+        f"bot_updates_total {metrics.updates}",
+    ]
+    render_histograms(lines, "bot_handler_seconds", "Time spent in each handler, outbound API calls included.", metrics.handlers, "handler")
+    render_counter(lines, "bot_handler_errors_total", "Exceptions raised by handlers.", metrics.handler_errors, ("handler", "error"))
+    render_counter(lines, "bot_state_updates_total", "Handled updates by the FSM state they arrived in.", metrics.states, ("state",))
+    render_histograms(lines, "bot_api_request_seconds", "Duration of each Bot API request attempt.", metrics.api_calls, "method")
+    render_counter(lines, "bot_api_errors_total", "Failed Bot API request attempts.", metrics.api_errors, ("method", "error"))
+    render_histograms(lines, "bot_persistence_seconds", "Duration of saves, flushes and SQLite writes.", metrics.saves, "operation")
+    render_counter(lines, "bot_cache_hits_total", "Cache lookups answered from memory.", {"search": search_cache.hits, "card": card_cache.hits}, ("cache",))
+    render_counter(lines, "bot_cache_misses_total", "Cache lookups that had to compute the value.", {"search": search_cache.misses, "card": card_cache.misses}, ("cache",))
+    render_counter(lines, "bot_cache_entries", "Entries held by each cache.", {
+        "search_snapshots": len(search_cache.snapshots), "search_live": len(search_cache.live), "card": len(card_cache.cards),
+    }, ("cache",), kind="gauge")
+    render_counter(lines, "bot_index_entries", "Keys held by each in-memory index.", {
+        "keyword_tokens": len(keyword_index.tokens), "keyword_prefixes": len(keyword_index.prefixes), "filter_cities": len(filter_index.by_city),
+        "geo_points": len(geo_index.points), "expiry_queue": len(expiry_queue.current), "outbound_chat_buckets": len(outbound_scheduler.chat_buckets),
+    }, ("index",), kind="gauge")
+    lines += [
+        "# HELP bot_active_listings Listings that have not expired.", "# TYPE bot_active_listings gauge",
+        f"bot_active_listings {active_listings}",
+        "# HELP bot_webhook_in_flight Webhook updates being handled.", "# TYPE bot_webhook_in_flight gauge",
+        f"bot_webhook_in_flight {len(webhook_tasks)}",
+    ]
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = METRICS_PORT + worker_index
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info(f"📈 Metrics on http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+def hit_rate(cache):
+    lookups = cache.hits + cache.misses
+    return f"{cache.hits / lookups:.0%}" if lookups else "n/a"
+
+# Every METRICS_LOG_INTERVAL: update rate and the busiest handlers of the interval, with their
+# all-time p95 bucket, plus API and cache totals
+async def metrics_log_worker():
+    last_updates = metrics.updates
+    last_counts = {name: histogram.count for name, histogram in metrics.handlers.items()}
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        counts = {name: histogram.count for name, histogram in metrics.handlers.items()}
+        busiest = sorted(((count - last_counts.get(name, 0), name) for name, count in counts.items()), reverse=True)[:5]
+        handlers = ", ".join(
+            f"{name} {delta}× p95≤{metrics.handlers[name].quantile(0.95) * 1000:.0f}ms" for delta, name in busiest if delta
+        )
+        api_calls = sum(histogram.count for histogram in metrics.api_calls.values())
+        logger.info(
+            f"📈 {metrics.updates - last_updates} updates in {METRICS_LOG_INTERVAL:.0f}s "
+            f"({(metrics.updates - last_updates) / METRICS_LOG_INTERVAL:.1f}/s); busiest: {handlers or 'none'}; "
+            f"API calls {api_calls}, errors {sum(metrics.api_errors.values())}; "
+            f"search cache hits {hit_rate(search_cache)}, card cache hits {hit_rate(card_cache)}"
+        )
+        last_updates, last_counts = metrics.updates, counts
+
+# 🌐 Webhook server: each update is acknowledged as soon as it is queued and handled in its own task.
+# At most WEBHOOK_MAX_IN_FLIGHT updates are handled at once; further requests wait for a slot before
+# being acknowledged, which makes Telegram slow down instead of the bot piling up tasks.
+webhook_slots = asyncio.Semaphore(WEBHOOK_MAX_IN_FLIGHT)
+webhook_tasks = set()
+
+async def process_webhook_update(update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.error(f"❌ Failed to handle update {update.update_id}: {e}")
+    finally:
+        webhook_slots.release()
+
+async def handle_webhook(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        logger.warning(f"⚠️ Rejected webhook request with a wrong secret token from {request.remote}")
+        return web.Response(status=401)
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except ValueError as e:
+        logger.warning(f"⚠️ Rejected malformed webhook update: {e}")
+        return web.Response(status=400)
+    await webhook_slots.acquire()
+    task = asyncio.create_task(process_webhook_update(update))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return web.Response()
+
+async def run_webhook():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WORKERS > 1).start()
+    logger.info(f"🌐 Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    # With several workers the supervisor registers the webhook once
+    if WEBHOOK_BASE_URL and WORKERS == 1:
+        await bot.set_webhook(url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if webhook_tasks:
+            await asyncio.gather(*webhook_tasks, return_exceptions=True)
+        await bot.session.close()
+
+async def change_feed_worker():
+    while True:
+        await asyncio.sleep(CHANGE_POLL_INTERVAL)
+        try:
+            await storage.sync_changes()
+        except Exception as e:
+            logger.error(f"❌ Failed to read the change log: {e}")
+
 async def main():
-    await load_user_data()
-    await load_listings()
-    await dp.start_polling(bot)
+    await storage.load()
+    expiry_task = asyncio.create_task(expiry_worker())
+    change_feed_task = asyncio.create_task(change_feed_worker()) if STORAGE_BACKEND == "sqlite" else None
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    metrics_log_task = asyncio.create_task(metrics_log_worker()) if METRICS_LOG_INTERVAL > 0 else None
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        expiry_task.cancel()
+        if change_feed_task is not None:
+            change_feed_task.cancel()
+        if metrics_log_task is not None:
+            metrics_log_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await storage.close()
+        await fsm_storage.close()
+        logger.info("💾 Pending changes flushed on shutdown.")
+        logger.info(f"🗂 Search cache: {search_cache.hits} hits, {search_cache.misses} misses.")
+
+# 👥 Multi-worker supervisor: migrates the stores once, registers the webhook, then runs WORKERS
+# spawned processes that each execute main() and share the listening port.
+async def prepare_workers():
+    await storage.load()
+    await storage.close()
+    await fsm_storage.close()
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    await bot.session.close()
+
+def run_worker(index):
+    global worker_index
+    worker_index = index
+    asyncio.run(main())
+
+def run_workers():
+    asyncio.run(prepare_workers())
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(i,), name=f"worker-{i + 1}") for i in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"👥 Started {WORKERS} workers: {', '.join(str(worker.pid) for worker in workers)}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: [worker.terminate() for worker in workers if worker.is_alive()])
+    for worker in workers:
+        while True:
+            try:
+                worker.join()
+                break
+            except KeyboardInterrupt:
+                # Ctrl+C reaches the whole process group; the workers shut down on their own
+                continue
+    logger.info("👥 All workers stopped.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WORKERS > 1:
+        run_workers()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,55 @@
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("FSM_STORAGE", "memory")
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def make_listing(listing_id, title, city="Quito"):
+    now = datetime.datetime.now()
+    category_id, _, label = bot.category_registry[0]
+    return {
+        'id': listing_id, 'user_id': 10, 'category': label, 'category_id': category_id,
+        'title': title, 'description': "", 'photo_id': "photo", 'additional_photo_ids': [],
+        'price': "5.00", 'status': "sell", 'is_free': False, 'location_type': 'city', 'city': city,
+        'latitude': None, 'longitude': None, 'contact': "0999999999",
+        'posted_at': now - datetime.timedelta(hours=1), 'expires_at': now + datetime.timedelta(days=3), 'views': 0, 'version': 0,
+    }
+
+
+# A fresh backend over empty module state; `open_storage()` opens another one on the same files, like a restart
+@pytest.fixture
+def open_storage(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "listings", {})
+    monkeypatch.setattr(bot, "user_data", {})
+
+    def open_storage(backend):
+        bot.listings, bot.user_data = {}, {}
+        for index in (bot.keyword_index, bot.filter_index, bot.geo_index):
+            index.rebuild({})
+        bot.expiry_queue.rebuild({})
+        storage = bot.SqliteStorage(str(tmp_path / "listings.db")) if backend == "sqlite" else bot.JsonStorage()
+        monkeypatch.setattr(bot, "storage", storage)
+        monkeypatch.setattr(bot, "search_cache", bot.SearchResultCache(16, 60))
+        asyncio.run(storage.load())
+        return storage
+
+    return open_storage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, open_storage):
+    storage = open_storage(request.param)
+    yield storage
+    asyncio.run(storage.close())
@@ -0,0 +1,60 @@
+import asyncio
+import itertools
+
+from aiogram import methods
+from aiogram.types import Message, Update
+
+import bot
+from conftest import make_listing
+
+update_ids = itertools.count(1)
+
+
+def message_update(user_id, text=None, location=None):
+    message = {
+        "message_id": next(update_ids), "date": 0, "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+    }
+    if text is not None:
+        message["text"] = text
+    if location is not None:
+        message["location"] = {"latitude": location[0], "longitude": location[1]}
+    return Update.model_validate({"update_id": next(update_ids), "message": message}, context={"bot": bot.bot})
+
+
+# Records every Bot API call instead of sending it; messages come back as a minimal Message
+def fake_api(monkeypatch):
+    sent = []
+
+    async def make_request(session, method, timeout=None):
+        sent.append(method)
+        if isinstance(method, (methods.SendMessage, methods.SendPhoto)):
+            return Message.model_validate(
+                {"message_id": next(update_ids), "date": 0, "chat": {"id": method.chat_id, "type": "private"}, "text": "x"},
+                context={"bot": bot.bot}
+            )
+        return True
+
+    monkeypatch.setattr(bot.bot.session, "make_request", make_request)
+    return sent
+
+
+# After nearby results are shown the main menu works again, instead of asking for a location
+def test_main_menu_works_after_nearby_search(storage, monkeypatch):
+    sent = fake_api(monkeypatch)
+    item = make_listing("1", "Silla")
+    item.update(location_type="geolocation", latitude=-0.18, longitude=-78.47)
+
+    async def scenario():
+        await storage.create_listing(item)
+        for update in (
+            message_update(10, "📍 Cerca de mí"),
+            message_update(10, location=(-0.18, -78.47)),
+            message_update(10, "📋 Mis anuncios"),
+        ):
+            await bot.dp.feed_update(bot.bot, update)
+
+    asyncio.run(scenario())
+    texts = [method.text for method in sent if isinstance(method, methods.SendMessage)]
+    assert "❗ Use el botón para enviar su ubicación." not in texts
+    assert texts[-1] == "📋 Seleccione un anuncio para ver:"
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+import bot
+
+RAW_LISTINGS = {
+    "1": {"id": "1", "title": "Silla {roja}, \"nueva\"", "additional_photo_ids": ["a", "b"], "price": "5.00", "latitude": None},
+    "2": {"id": "2", "title": "Lámpara ☕", "description": "", "additional_photo_ids": [], "is_free": True},
+    "10": {"id": "10", "title": "Mesa\\n", "nested": {"a": [1, 2.5, {"b": "}"}]}, "views": 0},
+}
+
+
+# Every chunk size cuts listings at a different place, so each one exercises the retry after a refill
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 16, 64, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 4])
+def test_reader_decodes_listings_across_chunk_boundaries(tmp_path, monkeypatch, chunk_size, indent):
+    monkeypatch.setattr(bot, "LOAD_CHUNK_SIZE", chunk_size)
+    path = tmp_path / "listings.json"
+    path.write_text(json.dumps(RAW_LISTINGS, ensure_ascii=False, indent=indent), encoding='utf-8')
+
+    reader = bot.ListingsFileReader(str(path))
+    batches = []
+    try:
+        while batch := reader.read_batch(2):
+            batches.append(batch)
+    finally:
+        reader.close()
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert dict(pair for batch in batches for pair in batch) == RAW_LISTINGS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 1 << 20])
+def test_reader_handles_empty_and_truncated_files(tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(bot, "LOAD_CHUNK_SIZE", chunk_size)
+    path = tmp_path / "listings.json"
+
+    path.write_text(" {\n} ", encoding='utf-8')
+    reader = bot.ListingsFileReader(str(path))
+    assert reader.read_batch(10) == []
+    reader.close()
+
+    path.write_text(json.dumps(RAW_LISTINGS)[:-20], encoding='utf-8')
+    reader = bot.ListingsFileReader(str(path))
+    try:
+        with pytest.raises(json.JSONDecodeError):
+            while reader.read_batch(10):
+                pass
+    finally:
+        reader.close()
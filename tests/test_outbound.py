@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+from aiogram import methods
+from aiogram.exceptions import TelegramRetryAfter
+
+import bot
+
+
+# A 429 on a chat-less call is retried, and holds back every chat through the global bucket
+def test_chatless_call_is_retried_and_pauses_global_bucket():
+    scheduler = bot.OutboundScheduler()
+    method = methods.AnswerCallbackQuery(callback_query_id="1")
+    attempts = []
+
+    async def make_request(_, method):
+        attempts.append((time.monotonic(), scheduler.global_limiter.bucket.paused_until))
+        if len(attempts) == 1:
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+        return True
+
+    assert asyncio.run(scheduler(make_request, bot.bot, method)) is True
+    assert len(attempts) == 2
+    (first_at, _), (_, paused_until) = attempts
+    assert paused_until >= first_at + 1
@@ -0,0 +1,36 @@
+import asyncio
+
+import bot
+from conftest import make_listing
+
+
+# A keyword that spells another query kind must still run as a keyword search
+def test_keyword_nearby_is_a_keyword_search(storage):
+    async def scenario():
+        await storage.create_listing(make_listing("1", "Nearby lamp"))
+        await storage.create_listing(make_listing("2", "Mesa"))
+        query = bot.search_query_key("Nearby", None, "")
+        _, results = await bot.run_search(query)
+        return query, list(results)
+
+    query, results = asyncio.run(scenario())
+    assert query[0] == bot.KEYWORD_QUERY
+    assert results == ["1"]
+    assert bot.query_matches_keys(query, ("Quito", bot.category_registry[0][0], False))
+
+
+# Ranking ties fall back to insertion order, so no two live listings may share a position
+def test_listing_created_after_delete_gets_a_new_position(open_storage):
+    storage = open_storage("json")
+
+    async def scenario():
+        for listing_id in ("1", "2", "3"):
+            await storage.create_listing(make_listing(listing_id, "Silla"))
+        await storage.delete_listing("1")
+        await storage.create_listing(make_listing("4", "Silla"))
+
+    try:
+        asyncio.run(scenario())
+        assert storage.positions["4"] > storage.positions["3"]
+    finally:
+        asyncio.run(storage.close())
@@ -0,0 +1,93 @@
+import asyncio
+import datetime
+
+import pytest
+
+import bot
+from conftest import make_listing
+
+
+async def create_listings(storage, count):
+    listing_ids = []
+    for _ in range(count):
+        listing_id = await storage.generate_listing_id()
+        await storage.create_listing(make_listing(listing_id, f"Silla {listing_id}"))
+        listing_ids.append(listing_id)
+    return listing_ids
+
+
+# Favorites and user_data may still point at a deleted id, so it must not come back after a restart,
+# including one that migrates the JSON files into SQLite
+@pytest.mark.parametrize("backend, restarted_backend", [("json", "json"), ("sqlite", "sqlite"), ("json", "sqlite")])
+def test_deleted_listing_id_is_not_reused_after_restart(open_storage, backend, restarted_backend):
+    storage = open_storage(backend)
+    listing_ids = asyncio.run(create_listings(storage, 3))
+    asyncio.run(storage.delete_listing(listing_ids[-1]))
+    asyncio.run(storage.close())
+
+    storage = open_storage(restarted_backend)
+    try:
+        assert asyncio.run(storage.generate_listing_id()) == str(int(listing_ids[-1]) + 1)
+    finally:
+        asyncio.run(storage.close())
+
+
+# search_text is rebuilt from the title and description on load, so no file or row keeps a copy
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_derived_fields_are_not_persisted(open_storage, backend, tmp_path):
+    storage = open_storage(backend)
+    listing_ids = asyncio.run(create_listings(storage, 2))
+    asyncio.run(storage.close())
+
+    assert not any(b"search_text" in path.read_bytes() for path in tmp_path.iterdir() if path.is_file())
+    storage = open_storage(backend)
+    try:
+        assert sorted(asyncio.run(storage.search_listings("silla", None, None, datetime.datetime.now()))) == sorted(listing_ids)
+    finally:
+        asyncio.run(storage.close())
+
+
+# A backend that misses part of the interface fails when it is created, not on the first call
+def test_incomplete_backend_cannot_be_instantiated():
+    class PartialStorage(bot.ListingStorage):
+        async def load(self):
+            pass
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+# An edit saved after the listing was deleted must not bring it back
+def test_update_after_delete_does_not_restore_listing(storage):
+    async def scenario():
+        [listing_id] = await create_listings(storage, 1)
+        item = dict(await storage.get_listing(listing_id))
+        await storage.delete_listing(listing_id)
+        item['title'] = "Mesa"
+        saved = await storage.update_listing(item)
+        return saved, await storage.get_listing(listing_id), await storage.search_listings("mesa", None, None, datetime.datetime.now())
+
+    saved, item, results = asyncio.run(scenario())
+    assert saved is False
+    assert item is None
+    assert list(results) == []
+
+
+# Same, with the delete made by another worker on the shared database
+def test_update_after_delete_by_other_worker(open_storage, tmp_path):
+    storage = open_storage("sqlite")
+    other = bot.SqliteStorage(str(tmp_path / "listings.db"))
+
+    async def scenario():
+        await other.load()
+        [listing_id] = await create_listings(storage, 1)
+        item = dict(await storage.get_listing(listing_id))
+        await other.delete_listing(listing_id)
+        saved = await storage.update_listing(item)
+        return saved, await storage.get_listing(listing_id)
+
+    try:
+        assert asyncio.run(scenario()) == (False, None)
+    finally:
+        asyncio.run(other.close())
+        asyncio.run(storage.close())